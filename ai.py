@@ -0,0 +1,220 @@
+import heapq
+import itertools
+import numpy
+
+import rendering
+import shapes
+import ships
+
+
+class Behaviour(object):
+  """What a computer controlled ship does, picked by the ship's AI name.
+
+  Think is called once the game time has passed the ship's
+  target_reevaluation. It makes its decisions and moves target_reevaluation
+  to when it wants to be called next. If it leaves it in the past, it is
+  called again on the next step.
+
+  cost is about how many milliseconds a Think takes. The scheduler counts
+  it against its budget instead of timing the call, so which ships think
+  on a step does not depend on how fast the machine is.
+  """
+  name = None
+  cost = 0.05
+
+  def Ready(self, ship):
+    """Whether Think has anything to do yet. Checked for free."""
+    return True
+
+  def Think(self, game, ship):
+    raise NotImplementedError
+
+
+def RandomWaypoint(game):
+  return (game.random.uniform(-0.9*rendering.RATIO, 0.9*rendering.RATIO), game.random.uniform(-0.9, 0.9))
+
+
+def Head(game, ship, waypoints, velocity=None):
+  """Sends the ship along the waypoints, starting now."""
+  if velocity is None:
+    velocity = (ship.dx, ship.dy)
+  ship.path_func = ships.ShipPathFromWaypoints(
+    (ship.x, ship.y), velocity, waypoints, ship.max_velocity)
+  ship.path_func_start_time = game.time
+
+
+class Wandering(Behaviour):
+  """Drifts from one random point to the next."""
+  name = 'Wandering'
+  cost = 0.01
+
+  def Think(self, game, ship):
+    if not ship.path_func:
+      Head(game, ship, [RandomWaypoint(game)])
+    # Look again once the path should be over.
+    ship.target_reevaluation = ship.path_func_start_time + ship.path_func.total_time
+
+
+class Kraken(Behaviour):
+  """Goes for the nearest enemy."""
+  name = 'Kraken'
+
+  def Think(self, game, ship):
+    ship.target_reevaluation = game.time + 2.0
+    nearest = game.NearestEnemy(ship)
+    ship.target = nearest
+    if nearest:
+      Head(game, ship, [(nearest.x, nearest.y)])
+
+
+class EvilNeedle(Behaviour):
+  """Traces the best of a few random shapes and the best polygon around."""
+  name = 'Evil Needle'
+  cost = 1.0
+  number_of_tries = 30
+
+  def Ready(self, ship):
+    return ship.shape_being_traced is None
+
+  def Think(self, game, ship):
+    ship.target_reevaluation = game.time + game.random.gauss(12.0, 2.0)
+    available_crystals = [c for c in game.crystals if not c.in_shape and c.visible]
+    if len(available_crystals) < 3:
+      return
+    shape_paths = []
+    for i in range(self.number_of_tries):
+      n = None
+      while not n or len(available_crystals) < n:
+        n = game.random.randint(3, 5)
+      shape_paths.append(game.random.sample(available_crystals, n))
+    best = game.crystals.polygons.Best()
+    if best:
+      shape_paths.append(best[1])
+    sides = numpy.array([len(p) for p in shape_paths])
+    corners = numpy.zeros((len(shape_paths), sides.max(), 2))
+    for i, p in enumerate(shape_paths):
+      corners[i, :len(p)] = [(c.x, c.y) for c in p]
+    shape_scores = shapes.ShapeScores(corners, sides)
+    # If an enemy is nearest to a corner, the score is lower.
+    nearest = game.entities.NearestIds(corners[:, :, 0].ravel(), corners[:, :, 1].ravel())
+    enemy = (game.entities.faction[nearest] != ship.faction).reshape(corners.shape[:2])
+    for i in range(corners.shape[1]):
+      shape_scores = numpy.where(enemy[:, i] & (i < sides), shape_scores * 0.4, shape_scores)
+    shape_path = shape_paths[numpy.argmax(shape_scores)]
+    shape_path += [shape_path[0]]
+    Head(game, ship, [(c.x, c.y) for c in shape_path], (0, 0))
+    ship.shape_being_traced = shapes.Shape(game)
+    ship.shape_being_traced.CompleteWithPath(shape_path)
+
+
+class ChasingShapes(Behaviour):
+  """Collects the nearest finished shape."""
+  name = 'Chasing shapes'
+  cost = 0.01
+
+  def Think(self, game, ship):
+    ship.target_reevaluation = game.time + 0.5
+    nearest = game.NearestObjectFromList(ship.x, ship.y, game.shapes)
+    if nearest and nearest != ship.target:
+      ship.target = nearest
+      Head(game, ship, [(nearest.x, nearest.y)])
+
+
+class Moron(Behaviour):
+  """Attacks when it has the mana and health for it, else collects shapes."""
+  name = 'Moron'
+
+  def Think(self, game, ship):
+    ship.target_reevaluation = game.time + ship.AI_smart
+    if (ship.mana >= 400 or ship.mana >= 200 and not game.NearestObjectFromList(ship.x, ship.y, game.shapes)) and ship.health > 1.5:
+      nearest = game.NearestEnemy(ship)
+    elif not game.NearestObjectFromList(ship.x, ship.y, game.shapes):
+      Head(game, ship, [RandomWaypoint(game)])
+      nearest = None
+    else:
+      nearest = game.NearestObjectFromList(ship.x, ship.y, game.shapes)
+    if nearest:
+      ship.target = nearest
+      Head(game, ship, [(nearest.x, nearest.y)])
+
+
+# AI name -> Behaviour
+BEHAVIOURS = dict((b.name, b()) for b in [Wandering, Kraken, EvilNeedle, ChasingShapes, Moron])
+
+
+class Scheduler(object):
+  """Calls the behaviours of ships when their reevaluation times come up.
+
+  Ships wait in a heap ordered by target_reevaluation, so a step only
+  touches the ships that are due. Ships whose AI name has no behaviour
+  (like the ones players control) are not scheduled.
+
+  With a budget, the scheduler stops calling behaviours once their costs
+  add up to that many milliseconds in a step. The ships left over are
+  still due and go first on the next step, so many ships replanning at
+  once are spread over a few steps. At least one ship is handled each
+  step. The costs are fixed estimates, so runs with the same seed play the
+  same on any machine, with or without a window.
+  """
+
+  def __init__(self, budget=None):
+    self.budget = budget
+    self.heap = []
+    self.entries = {}  # ship -> (AI name, sequence number of its heap entry)
+    self.counter = itertools.count()
+
+  def Sync(self, ships):
+    """Starts scheduling new ships and ships whose AI changed."""
+    live = set(ships)
+    for ship in self.entries.keys():
+      if ship not in live:
+        del self.entries[ship]
+    for ship in ships:
+      entry = self.entries.get(ship)
+      if entry is None or entry[0] != ship.AI:
+        if ship.AI in BEHAVIOURS:
+          self.Push(ship, ship.target_reevaluation)
+        else:
+          self.entries[ship] = (ship.AI, None)
+
+  def Reschedule(self, ship):
+    """Call after changing a ship's target_reevaluation from outside.
+
+    Later times are noticed anyway, but earlier ones only through this.
+    """
+    entry = self.entries.get(ship)
+    if entry and entry[1] is not None:
+      self.Push(ship, ship.target_reevaluation)
+
+  def Push(self, ship, due):
+    sequence = next(self.counter)
+    self.entries[ship] = (ship.AI, sequence)
+    heapq.heappush(self.heap, (due, sequence, ship))
+
+  def Update(self, game):
+    self.Sync(game.ships)
+    spent = 0
+    later = []
+    while self.heap and self.heap[0][0] < game.time:
+      due, sequence, ship = self.heap[0]
+      entry = self.entries.get(ship)
+      if entry is None or entry[1] != sequence:
+        # The ship is gone or was scheduled again.
+        heapq.heappop(self.heap)
+        continue
+      if ship.target_reevaluation > due:
+        # Put off by the game since it was scheduled.
+        heapq.heappop(self.heap)
+        self.Push(ship, ship.target_reevaluation)
+        continue
+      behaviour = BEHAVIOURS[ship.AI]
+      if behaviour.Ready(ship):
+        if spent and self.budget is not None and spent + behaviour.cost > self.budget:
+          break
+        behaviour.Think(game, ship)
+        spent += behaviour.cost
+      heapq.heappop(self.heap)
+      later.append(ship)
+    # Ships that are still due wait for the next step.
+    for ship in later:
+      self.Push(ship, ship.target_reevaluation)
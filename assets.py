@@ -1,3 +1,4 @@
+import multiprocessing.pool
 import pygame
 import OpenGL
 import sys
@@ -6,28 +7,86 @@ from OpenGL.GL import *
 import rendering
 
 
-def Help(vshader_src, fshader_src):
-    program = glCreateProgram()
-
-    for kind, src, txt in ((GL_VERTEX_SHADER, vshader_src, 'vertex'),
-                           (GL_FRAGMENT_SHADER, fshader_src, 'fragment')):
-        if src:
-            shader = glCreateShader(kind)
-            glShaderSource(shader, [src])
-            glCompileShader(shader)
-            result = glGetShaderiv(shader, GL_COMPILE_STATUS)
-            if not result:
-                print ('shader %s compilation failed: %s'
-                       % (txt, glGetShaderInfoLog(shader)))
-                sys.exit(1)
-            glAttachShader(program, shader)
-            glDeleteShader(shader)
-    glLinkProgram(program)
-    glValidateProgram(program)
-
-    return program
-
-def BackGroundShader():
+class ShaderProgram(object):
+    """A linked shader program with its uniform and attribute locations.
+
+    The locations are looked up once, after linking. Set skips the upload
+    when a uniform already has the given value. Use it as a context manager
+    to make the program current:
+
+      with program:
+        program.Set('alpha', 0.5)
+    """
+
+    # Uniform types that are set with glUniform*i.
+    INT_TYPES = (GL_INT, GL_BOOL, GL_SAMPLER_1D, GL_SAMPLER_2D)
+
+    def __init__(self, vshader_src, fshader_src, attributes=None):
+        """attributes maps attribute names to the locations to bind them to.
+        Binding keeps them away from location 0, which gl_Vertex may use."""
+        self.id = glCreateProgram()
+        for kind, src, txt in ((GL_VERTEX_SHADER, vshader_src, 'vertex'),
+                               (GL_FRAGMENT_SHADER, fshader_src, 'fragment')):
+            if src:
+                shader = glCreateShader(kind)
+                glShaderSource(shader, [src])
+                glCompileShader(shader)
+                if not glGetShaderiv(shader, GL_COMPILE_STATUS):
+                    self.Fail('%s shader compilation' % txt,
+                              glGetShaderInfoLog(shader), src)
+                glAttachShader(self.id, shader)
+                glDeleteShader(shader)
+        for name, location in (attributes or {}).items():
+            glBindAttribLocation(self.id, location, name)
+        glLinkProgram(self.id)
+        if not glGetProgramiv(self.id, GL_LINK_STATUS):
+            self.Fail('shader linking', glGetProgramInfoLog(self.id),
+                      vshader_src + '\n' + fshader_src)
+        glValidateProgram(self.id)
+
+        # name -> (location, type)
+        self.uniforms = {}
+        for i in range(glGetProgramiv(self.id, GL_ACTIVE_UNIFORMS)):
+            name, size, kind = glGetActiveUniform(self.id, i)
+            name = name.split('[')[0]
+            self.uniforms[name] = glGetUniformLocation(self.id, name), kind
+        self.attributes = {}
+        for i in range(glGetProgramiv(self.id, GL_ACTIVE_ATTRIBUTES)):
+            name, size, kind = glGetActiveAttrib(self.id, i)
+            if not name.startswith('gl_'):
+                self.attributes[name] = glGetAttribLocation(self.id, name)
+        self.values = {}
+
+    @staticmethod
+    def Fail(what, log, src):
+        print '%s failed: %s' % (what, log)
+        for number, line in enumerate(src.splitlines(), 1):
+            print '%4i  %s' % (number, line)
+        sys.exit(1)
+
+    def Set(self, name, *values):
+        """Sets a uniform of the current program. Unknown names are ignored,
+        as the driver drops uniforms the shader does not use."""
+        if self.values.get(name) == values or name not in self.uniforms:
+            return
+        self.values[name] = values
+        location, kind = self.uniforms[name]
+        if kind in self.INT_TYPES:
+            glUniform1i(location, *values)
+        else:
+            (glUniform1f, glUniform2f, glUniform3f, glUniform4f)[len(values) - 1](location, *values)
+
+    def Attribute(self, name):
+        return self.attributes[name]
+
+    def __enter__(self):
+        glUseProgram(self.id)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        glUseProgram(0)
+
+def BackGroundShader(water_image):
 
     data = (ctypes.c_ubyte * 5)()
     hl = 80
@@ -48,9 +107,7 @@ def BackGroundShader():
     global WATER_TEXTURE
 
     tex = glGenTextures(1)
-    surface = pygame.image.load("art/texture/water.png")
-    texture_size = surface.get_size()
-    raw_data = pygame.image.tostring(surface, 'RGBA', False)
+    raw_data, width, height = water_image
 
     glBindTexture(GL_TEXTURE_2D, tex)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER,
@@ -59,7 +116,7 @@ def BackGroundShader():
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
     glTexParameter(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_TRUE)
-    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, texture_size[0], texture_size[1], 0, GL_RGBA, GL_UNSIGNED_BYTE, raw_data)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, raw_data)
 
     WATER_TEXTURE = tex
 
@@ -96,16 +153,14 @@ void main() {
 """
 
     global BACKGROUND_PROGRAM
-    BACKGROUND_PROGRAM = Help(background_vertex_shader, background_fragment_shader)
+    BACKGROUND_PROGRAM = ShaderProgram(background_vertex_shader, background_fragment_shader)
 
-def CrystalShader():
+def CrystalShader(crystal_image):
 
     global CRYSTAL_TEXTURE
 
     tex = glGenTextures(1)
-    surface = pygame.image.load("art/texture/crystal.png")
-    texture_size = surface.get_size()
-    raw_data = pygame.image.tostring(surface, 'RGBA', False)
+    raw_data, width, height = crystal_image
 
     glBindTexture(GL_TEXTURE_2D, tex)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER,
@@ -114,7 +169,7 @@ def CrystalShader():
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
     glTexParameter(GL_TEXTURE_2D, GL_GENERATE_MIPMAP, GL_TRUE)
-    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, texture_size[0], texture_size[1], 0, GL_RGBA, GL_UNSIGNED_BYTE, raw_data)
+    glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, width, height, 0, GL_RGBA, GL_UNSIGNED_BYTE, raw_data)
 
     CRYSTAL_TEXTURE = tex
 
@@ -123,68 +178,168 @@ def CrystalShader():
 
 varying vec2 position;
 varying vec2 pos_tex;
+varying vec2 fade_out;
 uniform sampler2D crystal_tex;
-uniform float alpha;
 
 void main() {
   vec4 image = texture2D(crystal_tex, pos_tex);
-  gl_FragColor = vec4(vec3(image.rgb), alpha);
+  vec3 color = mix(image.rgb, vec3(1.0), 0.3 * fade_out.y);
+  gl_FragColor = vec4(color, fade_out.x);
 }
 """
+    # fade is (alpha, highlighted), the same on all corners of a crystal.
     crystal_vertex_shader = """
 #version 120
 
+attribute vec2 fade;
 varying vec2 position;
 varying vec2 pos_tex;
+varying vec2 fade_out;
  
 void main() {
   gl_Position = gl_ModelViewProjectionMatrix * gl_Vertex;
   gl_FrontColor = gl_Color;
   position = gl_Vertex.xy;
   pos_tex = gl_MultiTexCoord0.xy; 
+  fade_out = fade;
 }
 
 """
     global CRYSTAL_PROGRAM
-    CRYSTAL_PROGRAM = Help(crystal_vertex_shader, crystal_fragment_shader)
-
-
-class Meshes(object):
-    @classmethod
-    def Init(self):
-        self.ship = rendering.ObjMesh(
-            'models/ship/Ship.obj',
-            rendering.Texture(pygame.image.load(
-                    'models/ship/Ship.png'), mipmap=True),
-            scale=[0.5, 0.5, 0.5],
-            offset=[0.0, 0.0, 0.0])
-        self.other_ship = rendering.ObjMesh(
-            'models/other-ship/OtherShip.obj',
-            rendering.Texture(pygame.image.load(
-                    'models/other-ship/OtherShip.png'), mipmap=True),
-            scale=[0.35, 0.35, 0.35],
-            offset=[0.0, 0.0, 0.0])
-        self.plane = rendering.ObjMesh(
-            'models/plane/paper-plane.obj',
-            rendering.Texture(pygame.image.load(
-                    'models/plane/paper-plane.png'), mipmap=True),
-            scale=[0.6, 0.6, 0.6],
-            offset=[0.0, 1.5, 0.0])
-        self.jellyfish = rendering.ObjMesh(
-            'models/jellyfish/Jellyfish.obj',
-            rendering.Texture(pygame.image.load(
-                    'models/jellyfish/Jellyfish.png'), mipmap=True),
-            scale=[0.2, 0.2, 0.2],
-            offset=[0, 0, 0])
-        self.kraken = rendering.ObjMesh(
-            'models/kraken/Kraken.obj',
-            rendering.Texture(pygame.image.load(
-                    'models/kraken/Kraken.png'), mipmap=True),
-            scale=[0.2, 0.2, 0.2],
-            offset=[0, 0.1, 0])
-
-
-def Init():
-    BackGroundShader()
-    CrystalShader()
-    Meshes.Init()
+    CRYSTAL_PROGRAM = ShaderProgram(crystal_vertex_shader, crystal_fragment_shader,
+                                    attributes={'fade': 1})
+
+
+# Mesh name -> (OBJ file, texture file, scale, offset).
+MESHES = {
+    'ship': ('models/ship/Ship.obj', 'models/ship/Ship.png',
+             [0.5, 0.5, 0.5], [0.0, 0.0, 0.0]),
+    'other_ship': ('models/other-ship/OtherShip.obj',
+                   'models/other-ship/OtherShip.png',
+                   [0.35, 0.35, 0.35], [0.0, 0.0, 0.0]),
+    'plane': ('models/plane/paper-plane.obj', 'models/plane/paper-plane.png',
+              [0.6, 0.6, 0.6], [0.0, 1.5, 0.0]),
+    'jellyfish': ('models/jellyfish/Jellyfish.obj',
+                  'models/jellyfish/Jellyfish.png',
+                  [0.2, 0.2, 0.2], [0, 0, 0]),
+    'kraken': ('models/kraken/Kraken.obj', 'models/kraken/Kraken.png',
+               [0.2, 0.2, 0.2], [0, 0.1, 0]),
+}
+
+
+def LoadMeshData(name):
+    """The part of loading a mesh that does not need OpenGL."""
+    if rendering.HEADLESS:
+        return None, None
+    obj, png, scale, offset = MESHES[name]
+    return rendering.LoadObj(obj, scale, offset), rendering.LoadImage(png)
+
+
+def MakeMesh(name, data):
+    """Uploads the result of LoadMeshData. Main thread only."""
+    mesh_data, image = data
+    obj, png, scale, offset = MESHES[name]
+    texture = rendering.TEXTURES.Get(png, mipmap=True, image=image)
+    return rendering.ObjMesh(obj, texture, scale, offset, data=mesh_data)
+
+
+class Loader(object):
+    """Decodes and parses asset files on worker threads.
+
+    Each job has a function that runs on a worker and a callback that gets
+    its result on the main thread, where the OpenGL upload happens.
+    """
+
+    def __init__(self, workers=4):
+        self.pool = multiprocessing.pool.ThreadPool(workers)
+        self.jobs = []
+        self.total = 0
+        self.done = 0
+
+    def Add(self, work, args, upload):
+        self.jobs.append((self.pool.apply_async(work, args), upload))
+        self.total += 1
+
+    def Poll(self):
+        """Runs the callbacks of finished jobs. Returns True if any ran."""
+        finished = [job for job in self.jobs if job[0].ready()]
+        for job in finished:
+            self.jobs.remove(job)
+            result, upload = job
+            upload(result.get())
+            self.done += 1
+        return bool(finished)
+
+    def Finish(self, progress=None):
+        """Waits for all jobs, calling progress(fraction) after each upload."""
+        if progress:
+            progress(0.0)
+        while self.jobs:
+            if self.Poll():
+                if progress:
+                    progress(float(self.done) / self.total)
+            else:
+                self.jobs[0][0].wait(0.01)
+
+
+class MeshRegistry(object):
+    """The meshes in MESHES, loaded the first time each one is used.
+
+    Prefetch starts loading a mesh on the worker threads ahead of time, and
+    Poll uploads the ones that are ready, so the first use does not stall.
+    """
+
+    def __init__(self):
+        self.meshes = {}
+        self.pending = {}
+
+    def __getattr__(self, name):
+        if name not in MESHES:
+            raise AttributeError(name)
+        if name not in self.meshes:
+            if name in self.pending:
+                self.Add(name, self.pending[name].get())
+            else:
+                self.Add(name, LoadMeshData(name))
+        return self.meshes[name]
+
+    def Add(self, name, data):
+        """Uploads the result of LoadMeshData(name). Main thread only."""
+        self.pending.pop(name, None)
+        self.meshes[name] = MakeMesh(name, data)
+
+    def Prefetch(self, *names):
+        if LOADER is None:
+            return
+        for name in names:
+            if name not in self.meshes and name not in self.pending:
+                self.pending[name] = LOADER.pool.apply_async(LoadMeshData, (name,))
+
+    def Poll(self):
+        """Uploads at most one prefetched mesh. Call once per frame."""
+        for name, result in self.pending.items():
+            if result.ready():
+                getattr(self, name)
+                return
+
+Meshes = MeshRegistry()
+# Worker pool for background loading. Not used when headless.
+LOADER = None
+# Meshes the opening scene needs. The rest load on demand.
+STARTUP_MESHES = ('ship', 'plane')
+
+
+def Init(progress=None):
+    """Loads the startup assets. progress(fraction) is called as they come in."""
+    if rendering.HEADLESS:
+        return
+    global LOADER
+    LOADER = Loader()
+    LOADER.Add(rendering.LoadImage, ('art/texture/water.png', False),
+               BackGroundShader)
+    LOADER.Add(rendering.LoadImage, ('art/texture/crystal.png', False),
+               CrystalShader)
+    for name in STARTUP_MESHES:
+        LOADER.Add(LoadMeshData, (name,),
+                   lambda data, name=name: Meshes.Add(name, data))
+    LOADER.Finish(progress)
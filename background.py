@@ -1,27 +1,30 @@
 import OpenGL
 import math
+import numpy
 from OpenGL.GL import *
 import assets
+import geometry
 
 class BackGround(object):
     def __init__(self, x, y, color):
         self.x = x
         self.y = y
         self.color = color
+        self.triangles = geometry.Quads(numpy.array([[
+            (x[0], y[1], -0.01),
+            (x[0], y[0], -0.01),
+            (x[1], y[0], -0.01),
+            (x[1], y[1], -0.01)]]))
 
     def Draw(self, time, second_pass):
-        glUseProgram(assets.BACKGROUND_PROGRAM)
+        program = assets.BACKGROUND_PROGRAM
+        glUseProgram(program.id)
 
         glActiveTexture(GL_TEXTURE0)
         glBindTexture(GL_TEXTURE_1D, assets.WAVE_TEXTURE)
-        location = glGetUniformLocation(assets.BACKGROUND_PROGRAM, 'tex')
-        glUniform1i(location, 0)
-
-        location = glGetUniformLocation(assets.BACKGROUND_PROGRAM, 'offset')
-        glUniform1f(location, time%100)
-
-        location = glGetUniformLocation(assets.BACKGROUND_PROGRAM, 'color')
-        glUniform4f(location, 0., 0.3, 0.75, 0.7)
+        program.Set('tex', 0)
+        program.Set('offset', time%100)
+        program.Set('color', 0., 0.3, 0.75, 0.7)
 
         if second_pass:
             glDepthFunc(GL_LESS)
@@ -29,12 +32,8 @@ class BackGround(object):
         else:
             glDisable(GL_DEPTH_TEST)
             glDisable(GL_BLEND)
-        glBegin(GL_QUADS)
-        glVertex(self.x[0], self.y[1], -0.01)
-        glVertex(self.x[0], self.y[0], -0.01)
-        glVertex(self.x[1], self.y[0], -0.01)
-        glVertex(self.x[1], self.y[1], -0.01)
-        glEnd()
+        geometry.STREAM.Add(GL_TRIANGLES, self.triangles, (1, 1, 1, 1))
+        geometry.STREAM.Flush(GL_TRIANGLES)
         if second_pass:
             glDepthFunc(GL_ALWAYS)
         else:
@@ -4,10 +4,14 @@ import rendering
 import random
 import math
 import numpy
+import polygons
 import shapes
+import spatial
+
+# Cell size of the crystal index. Mouse hit tests look this far around a point.
+CRYSTAL_GRID_CELL = shapes.DISTANCE_THRESHOLD
 
 class Crystal(object):
-  vbo = None
   def __init__(self, loc, start_fade_in_time=0, fade_in_time=1):
     self.x, self.y = loc
     self.type = 0
@@ -17,8 +21,8 @@ class Crystal(object):
     self.t = self.start_fade_in_time + self.fade_in_time
     self.matching = False
     self.in_shape = False
-    if not Crystal.vbo:
-      Crystal.vbo = rendering.Quad(0.03, 0.03)
+    # Set by Crystals.Add, unique within one Crystals.
+    self.id = None
 
   def DistanceFromCoord(self, x, y):
     return math.hypot(self.x - x, self.y - y)
@@ -29,23 +33,99 @@ class Crystal(object):
     if self.t <= self.fade_in_time / 2:
       self.visible = True
 
-  def Render(self):
-    if self.t < self.fade_in_time:
-      alpha = 1 - (self.t / self.fade_in_time)
-      glPushMatrix()
-      glTranslatef(self.x, self.y, 0)
-      Crystal.vbo.RenderCrystal(alpha, self.matching)
-      glPopMatrix()
+  def Alpha(self):
+    return 1 - (self.t / self.fade_in_time)
 
   def __repr__(self):
     return "Crystal at %2f:%2f" % (self.x, self.y)
 
+class CrystalPlacer(object):
+  """Picks spots for new crystals by Poisson-disk sampling.
+
+  Spots that make a 120, 90 or 72 degree corner with two existing crystals
+  are tried first, so the field keeps offering shapes. The one with the
+  most room around it wins, if no crystal is closer than min_distance.
+
+  Else Bridson's algorithm spreads the crystals out: spots are tried in the
+  ring between radius and twice that around a random active crystal, and
+  the first one with no crystal within radius is taken. A crystal whose
+  ring is full stops being active. The radius follows the mean spacing
+  max_crystals would have on the field, so the crystals are as spread out
+  as before at any count. Only when no crystal is active is the roomiest
+  of a few random spots taken.
+
+  The room around a spot comes from the crystal index, so a spot costs a
+  look at a few grid cells instead of a scan of all crystals.
+  """
+  degrees = (120, 90, 72)
+
+  def __init__(self, crystals, min_distance=0.1, spacing=0.55, shape_tries=20, ring_tries=20, random_tries=10):
+    """The Poisson-disk radius is spacing times the mean spacing of
+    max_crystals crystals on the field."""
+    self.crystals = crystals
+    self.min_distance = min_distance
+    self.spacing = spacing
+    self.shape_tries = shape_tries
+    self.ring_tries = ring_tries
+    self.random_tries = random_tries
+    # Crystals that may still have free spots around them.
+    self.active = []
+
+  def Radius(self):
+    c = self.crystals
+    area = (c.max_x - c.min_x) * (c.max_y - c.min_y)
+    return self.spacing * math.sqrt(area / max(c.max_crystals, 1))
+
+  def Activate(self, crystal):
+    self.active.append(crystal)
+
+  def Freed(self, crystal):
+    """A crystal was removed, so its neighbours may have room again."""
+    if crystal in self.active:
+      self.active.remove(crystal)
+    for neighbour in self.crystals.Query(crystal.x, crystal.y, 2 * self.Radius()):
+      if neighbour is not crystal and neighbour not in self.active:
+        self.active.append(neighbour)
+
+  def IsFree(self, loc, radius):
+    c = self.crystals
+    if not (c.min_x < loc[0] < c.max_x and c.min_y < loc[1] < c.max_y):
+      return False
+    for crystal in c.Query(loc[0], loc[1], radius):
+      if crystal.DistanceFromCoord(*loc) < radius:
+        return False
+    return True
+
+  def Place(self):
+    c = self.crystals
+    degree = c.random.choice(self.degrees)
+    locations = [
+      (c.MinDistanceFromExistingCrystals(loc)[0], loc)
+      for loc in [c.GetLocationCreatingAShape(degree) for i in range(self.shape_tries)]
+      if loc is not None
+    ]
+    if locations:
+      best_distance, best_location = max(locations)
+      if best_distance >= self.min_distance:
+        return best_location
+    radius = self.Radius()
+    while self.active:
+      i = c.random.randrange(len(self.active))
+      crystal = self.active[i]
+      for j in range(self.ring_tries):
+        angle = c.random.uniform(0, 2 * math.pi)
+        distance = c.random.uniform(radius, 2 * radius)
+        loc = (crystal.x + distance * math.cos(angle), crystal.y + distance * math.sin(angle))
+        if self.IsFree(loc, radius):
+          return loc
+      self.active[i] = self.active[-1]
+      self.active.pop()
+    return c.GetGoodRandomLocation(self.random_tries)
+
+
 class Crystals(object):
   states = ['NoCrystals', 'OneTriangle', 'KeepMax']
-
-  def rotation_matrix(self, degree):
-    rad = math.radians(degree)
-    return numpy.matrix([[math.cos(rad), -math.sin(rad)], [math.sin(rad), math.cos(rad)]])
+  batch = None
 
   def __len__(self):
     return len(self.crystals)
@@ -55,22 +135,33 @@ class Crystals(object):
 
   def UpdateOneTriangle(self, dt, game):
     if len(self.crystals) == 0:
-      self.crystals.append(Crystal((-0.5, -0.5)))
-      self.crystals.append(Crystal((-0.5, 0)))
-      self.crystals.append(Crystal((-0.067, -0.25)))
+      self.Add(Crystal((-0.5, -0.5)))
+      self.Add(Crystal((-0.5, 0)))
+      self.Add(Crystal((-0.067, -0.25)))
 
   def UpdateKeepMax(self, dt, game):
     crystals_needed = self.max_crystals - len(self.crystals)
     if crystals_needed > 0:
       self.CreateCrystals(crystals_needed)
 
-  def __init__(self, max_crystals, min_x=-0.9*rendering.RATIO, max_x=0.9*rendering.RATIO, min_y=-0.9, max_y=0.9):
+  def __init__(self, max_crystals, min_x=-0.9*rendering.RATIO, max_x=0.9*rendering.RATIO, min_y=-0.9, max_y=0.9, rng=None):
+    self.random = rng or random.Random()
     self.min_x = min_x
     self.max_x = max_x
     self.min_y = min_y
     self.max_y = max_y
     self.max_crystals = max_crystals
     self.crystals = []
+    # All crystals, including those in shapes. Callers filter on in_shape.
+    self.index = spatial.SpatialHash(CRYSTAL_GRID_CELL)
+    # (point, crystal) for each point of the drawing seen so far. crystal is
+    # the nearest one if it is close enough to match, else None.
+    self.point_matches = []
+    # crystal -> number of drawing points it matches.
+    self.match_counts = {}
+    self.placer = CrystalPlacer(self)
+    self.polygons = polygons.PolygonIndex(self)
+    self.next_id = 0
     self.SetState('NoCrystals')
 
   def __iter__(self):
@@ -78,7 +169,29 @@ class Crystals(object):
   def __getitem__(self, key):
     return self.crystals.__getitem__(key)
   def remove(self, key):
-    return self.crystals.remove(key)
+    self.crystals.remove(key)
+    self.index.Remove(key, key.x, key.y)
+    self.placer.Freed(key)
+    self.polygons.Remove(key)
+    for i, (point, crystal) in enumerate(self.point_matches):
+      if crystal is key:
+        self.SetMatch(i, self.MatchPoint(point))
+
+  def Add(self, crystal):
+    crystal.id = self.next_id
+    self.next_id += 1
+    self.crystals.append(crystal)
+    self.index.Insert(crystal, crystal.x, crystal.y)
+    self.placer.Activate(crystal)
+    for i, (point, matched) in enumerate(self.point_matches):
+      distance = crystal.DistanceFromCoord(*point)
+      if distance < shapes.DISTANCE_THRESHOLD and (
+          matched is None or distance < matched.DistanceFromCoord(*point)):
+        self.SetMatch(i, crystal)
+
+  def Query(self, x, y, radius):
+    """Crystals that may be within radius of (x, y), in list order."""
+    return self.index.Query(x, y, radius)
 
   def SetState(self, name):
     if name in self.states:
@@ -93,19 +206,25 @@ class Crystals(object):
       raise Exception("no such Crystals state " + name)
 
   def MinDistanceFromExistingCrystals(self, coord):
-    return min([(1000, None)] + [(crystal.DistanceFromCoord(*coord), crystal) for crystal in self.crystals])
+    distance, crystal = self.index.Nearest(*coord)
+    if crystal is None or distance > 1000:
+      return 1000, None
+    return distance, crystal
 
   def GetGoodRandomLocation(self, number_of_tries=10):
-    centers = [(random.uniform(self.min_x, self.max_x), random.uniform(self.min_y, self.max_y)) for i in range(number_of_tries)]
+    centers = [(self.random.uniform(self.min_x, self.max_x), self.random.uniform(self.min_y, self.max_y)) for i in range(number_of_tries)]
     distances = [self.MinDistanceFromExistingCrystals(center)[0] for center in centers]
     return max(zip(distances, centers))[1]
 
   def GetLocationCreatingAShape(self, degree):
+    """Turns the line between two random crystals by degree around one of
+    them. Returns where it ends, or None if that is off the field."""
     if len(self.crystals) > 1:
-      c1, c2 = random.sample(self.crystals, 2)
-      v1, v2 = numpy.array((c2.x, c2.y)), numpy.array((c1.x, c1.y))
-      v3 = (v2 - v1) * self.rotation_matrix(degree) + v2
-      new_loc = (v3.item(0), v3.item(1))
+      c1, c2 = self.random.sample(self.crystals, 2)
+      rad = math.radians(degree)
+      cos, sin = math.cos(rad), math.sin(rad)
+      dx, dy = c1.x - c2.x, c1.y - c2.y
+      new_loc = (c1.x + dx * cos + dy * sin, c1.y - dx * sin + dy * cos)
       if self.min_x < new_loc[0] < self.max_x and self.min_y < new_loc[1] < self.max_y:
         return new_loc
     return None
@@ -138,34 +257,57 @@ class Crystals(object):
   #   return best_polygon['crystals']
 
   def CreateCrystals(self, number):
-    number_of_tries = 20
-    distance_threshold = 0.1
-
-    interesting_degrees = (120, 90, 72)
     for i in range(number):
-      degree = random.choice(interesting_degrees)
-      locations = [
-        (self.MinDistanceFromExistingCrystals(loc)[0], loc)
-        for loc in [self.GetLocationCreatingAShape(degree) for i in range(number_of_tries)]
-        if loc is not None
-      ]
-      if len(locations) == 0:
-        crystal = Crystal(self.GetGoodRandomLocation(), start_fade_in_time=random.uniform(1, 8), fade_in_time=random.uniform(2, 4))
-      else:
-        best_distance, best_location = max(locations)
-        if best_distance < distance_threshold:
-          crystal = Crystal(self.GetGoodRandomLocation(), start_fade_in_time=random.uniform(1, 8), fade_in_time=random.uniform(2, 4))
-        else:
-          crystal = Crystal(best_location, start_fade_in_time=random.uniform(1, 8), fade_in_time=random.uniform(2, 4))
-      self.crystals.append(crystal)
+      crystal = Crystal(self.placer.Place(), start_fade_in_time=self.random.uniform(1, 8), fade_in_time=self.random.uniform(2, 4))
+      self.Add(crystal)
+
+  def MatchPoint(self, point):
+    """The crystal a drawing point matches, or None."""
+    distance, crystal = self.MinDistanceFromExistingCrystals(point)
+    if distance < shapes.DISTANCE_THRESHOLD:
+      return crystal
+    return None
+
+  def SetMatch(self, i, crystal):
+    point, old = self.point_matches[i]
+    if old is not None:
+      self.match_counts[old] -= 1
+      if not self.match_counts[old]:
+        del self.match_counts[old]
+    if crystal is not None:
+      self.match_counts[crystal] = self.match_counts.get(crystal, 0) + 1
+    self.point_matches[i] = point, crystal
+
+  def UpdateMatches(self, drawing):
+    """Brings the matches up to date with the drawing.
+
+    The drawing only changes at its end, points are appended or popped, or
+    it is replaced with a new list. So only the points after the longest
+    unchanged start need to be looked at.
+    """
+    matches = self.point_matches
+    keep = min(len(matches), len(drawing))
+    while keep and matches[keep - 1][0] is not drawing[keep - 1]:
+      keep -= 1
+    for i in xrange(keep, len(matches)):
+      self.SetMatch(i, None)
+    del matches[keep:]
+    for point in drawing[keep:]:
+      matches.append((point, None))
+      self.SetMatch(len(matches) - 1, self.MatchPoint(point))
 
   def Update(self, dt, game):
     getattr(self, 'Update' + self.state)(dt, game)
-    min_distances = [self.MinDistanceFromExistingCrystals(coord) for coord in game.drawing]
-    crystals_matching_path = [crystal for distance, crystal in min_distances if distance < shapes.DISTANCE_THRESHOLD]
+    self.UpdateMatches(game.drawing)
     for crystal in self.crystals:
-      crystal.Update(dt, crystal in crystals_matching_path)
+      crystal.Update(dt, crystal in self.match_counts)
+      self.polygons.Sync(crystal)
 
   def Render(self):
-    for crystal in self.crystals:
-      crystal.Render()
+    if Crystals.batch is None:
+      Crystals.batch = rendering.CrystalBatch(0.03, 0.03)
+    shown = [crystal for crystal in self.crystals if crystal.t < crystal.fade_in_time]
+    Crystals.batch.Render([crystal.x for crystal in shown],
+                          [crystal.y for crystal in shown],
+                          [crystal.Alpha() for crystal in shown],
+                          [crystal.matching for crystal in shown])
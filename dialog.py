@@ -4,22 +4,24 @@ import os
 import pygame
 import random
 import re
+import assets
 import rendering
 import ships
 import sys
 from OpenGL.GL import *
 
 class DialogLine(object):
-  textures = {}
   side = 'left'
   quad = None
 
-  def __init__(self, text, label='', face='', trigger=None, action=None, voice=None):
+  def __init__(self, text, label='', face='', trigger=None, action=None, voice=None, prefetch=()):
     self.text = text
     self.label = label
     self.face = face
     self.trigger = trigger
     self.action = action
+    # Meshes to start loading while this line is current.
+    self.prefetch = prefetch
     self.t = 0
     self.spoken = False
     if not voice:
@@ -35,26 +37,29 @@ class DialogLine(object):
     glColor(1, 1, 1, 1)
     x = math.exp(-20 * self.t)
     sign = 1 if self.side == 'right' else -1
-    with self.GetTexture(self.face) as texture:
+    texture = self.GetTexture(self.face)
+    with texture:
       glPushMatrix()
       glTranslate(sign * (x + rendering.RATIO - 0.5 * texture.width), -1 + 0.5 * texture.height, 0)
       glScale(texture.width, texture.height, 1)
       self.quad.Render()
       glPopMatrix()
+    rendering.TEXTURES.Release(texture)
 
   def GetTexture(self, which):
+    """Returns a portrait. Give it back with rendering.TEXTURES.Release."""
     filename = 'art/portraits/' + self.character
     if which:
       filename += '-' + which
     filename += '.png'
-    if filename not in self.textures:
-      self.textures[filename] = rendering.Texture(pygame.image.load(filename))
-    return self.textures[filename]
+    return rendering.TEXTURES.Get(filename)
 
   def Speak(self):
     if self.spoken:
       return
     self.spoken = True
+    if rendering.HEADLESS:
+      return
     if os.path.exists(self.voice_filename):
       try:
         self.sound = pygame.mixer.Sound(self.voice_filename)
@@ -91,16 +96,16 @@ class Group(DialogLine):
   character = 'Group'
 
 
-class HUD(rendering.Texture):
+class HUD(object):
 
   def __init__(self, filename):
-    rendering.Texture.__init__(self, pygame.image.load(filename))
+    self.icon = rendering.TEXTURES.Get(filename)
     self.lastvalue = None
     self.text = None
 
   def Render(self, x, value):
     glColor(1, 1, 1, 1)
-    with self as t:
+    with self.icon as t:
       glPushMatrix()
       glTranslate(-rendering.RATIO + 0.5 * t.width + x, 1 - 0.5 * t.height, 0)
       glScale(t.width, t.height, 1)
@@ -119,10 +124,10 @@ class HUD(rendering.Texture):
       Dialog.quad.Render()
       glPopMatrix()
 
-def OnEdge(z):
+def OnEdge(game, z):
   while True:
-    x = random.uniform(-1.5, 1.5)
-    y = random.uniform(-1.5, 1.5)
+    x = game.random.uniform(-1.5, 1.5)
+    y = game.random.uniform(-1.5, 1.5)
     if not (abs(x) < 1.2 and abs(y) < 1.2):
       return x, y, z
 
@@ -153,7 +158,8 @@ Father(u'Just right click on the shape and I’ll come and haul it in.'),
 Father(u'Or use A, S, D and W to guide me there if you prefer.'),
 
 Father(u'Oh, your mother will summon us a delicious dinner using this Mana when we get home!',
-       face='laughing', trigger=lambda game: game.father_ship.mana > 0),
+       face='laughing', trigger=lambda game: game.father_ship.mana > 0,
+       prefetch=('jellyfish',)),
 Father(u'Let us collect at least 1,000,000 so it feeds the whole family.'),
 Father(u'Bigger regular shapes with more crystals give even more Mana.'),
 Father(u'And arcane shapes, like a pentagram, yield twice as much.'),
@@ -164,14 +170,14 @@ Kid(u'Look, jellyfish! Can they speak?', face='wonder',
     trigger=lambda game: game.father_ship.mana >= 1000),
 Jellyfish(u'Yes we can, tasty human!'),
 Father(u'Keep the Needle away from them! I will handle these beasts. We can use some mana to fight them!',
-       action=lambda game: [game.AddEnemy(ships.JellyFish(*OnEdge(random.gauss(0.15, 0.03)))) for i in range(7)]),
+       action=lambda game: [game.AddEnemy(ships.JellyFish(*OnEdge(game, game.random.gauss(0.15, 0.03)))) for i in range(7)]),
 
 Kid(u'What was that? A ship under the water snatched our Mana!',
-    face='scared', trigger=Victory),
+    face='scared', trigger=Victory, prefetch=('other_ship',)),
 Father(u'It’s an Undership!'),
 Father(u'On the Sea of Good and Bad our reflections have their own minds.'),
 Father(u'And they will steal our dinner if we let them!',
-        action=lambda game: [game.AddEnemy(ships.OtherBigShip(*OnEdge(0.2), AI='Chasing shapes'))]),
+        action=lambda game: [game.AddEnemy(ships.OtherBigShip(*OnEdge(game, 0.2), AI='Chasing shapes'))]),
 
 Kid(u'Victory! The Undership is retreating!', face='wonder', trigger=Victory),
 Father(u'All the bad thoughts we think sink to the bottom of the water and form your Nemesis and mine.'),
@@ -182,9 +188,10 @@ AuntMenace(u'What a lovely family!', face='laughing', trigger=lambda game: game.
 AuntMenace(u'Thank you for showing the way to this rich field of crystals!'),
 Father(u'Creta, unfold your sails.'),
 Father(u'Your aunt knows no mercy. We have to defend ourselves!',
-       action=lambda game: game.AddEnemy(ships.OtherBigShip(*OnEdge(0.3)), with_small_ship=True)),
+       action=lambda game: game.AddEnemy(ships.OtherBigShip(*OnEdge(game, 0.3)), with_small_ship=True)),
 
-AuntMenace(u'I see you’re not a child anymore, Creta.', trigger=Victory),
+AuntMenace(u'I see you’re not a child anymore, Creta.', trigger=Victory,
+           prefetch=('kraken',)),
 AuntMenace(u'Maybe one day you’ll pilot my Needle and we will terrorize the harbors together.', face='laughing'),
 AuntMenace(u'Until then!', face='laughing'),
 Kid(u'Why does Aunt Menace have to be like that...', face='scared'),
@@ -204,7 +211,7 @@ Kraken(u'Let me take my prey to the Kingdom Under the Waves.'),
 Tom(u'Not so fast, Kraken!'),
 Tom(u'I will fight along these brave sailors and make our stand against your evil.',
        action=lambda game: [game.AddEnemy(ships.Kraken(-0.1, -0.8, 0.7)),
-                            game.AddAlly(ships.OurBigShip(*OnEdge(0.3)))]),
+                            game.AddAlly(ships.OurBigShip(*OnEdge(game, 0.3)))]),
 
 Father(u'Thank you, stranger.', trigger=Victory),
 Father(u'What a day! I wonder what stirred the old beast...'),
@@ -214,7 +221,7 @@ Tom(u'Uh-oh, looks like my Nemesis has caught up with me.'),
 Tom(u'Which side will you take, brave sailors?'),
 Father(u'No Underman is my friend.'),
 Tom(u'Then prepare to meet the Prince of Turtles in combat!',
-    action=lambda game: game.AddEnemy(ships.OtherBigShip(*OnEdge(0.3)), with_small_ship=True)),
+    action=lambda game: game.AddEnemy(ships.OtherBigShip(*OnEdge(game, 0.3)), with_small_ship=True)),
 
 Prince(u'Why are you defending this criminal?', trigger=Victory),
 Prince(u'He stole from me!'),
@@ -239,7 +246,7 @@ AuntMenace(u'So happy to meet you one last time, Victoria!'),
 AuntMenace(u'My dear Tom has brought you here so we can become one.'),
 AuntMenace(u'By subtracting you and adding endless power to me!'),
 Victoria(u'Help me!', face='scared',
-         action=lambda game: [game.AddEnemy(ships.OtherBigShip(*OnEdge(0.3)), with_small_ship=True),
+         action=lambda game: [game.AddEnemy(ships.OtherBigShip(*OnEdge(game, 0.3)), with_small_ship=True),
                               game.TomBetrayal()]),
 
 AuntMenace(u'Argh! This cannot be! I’m sinking!', trigger=Victory),
@@ -255,9 +262,9 @@ Kid(u'...', face='scared'),
 Kid(u'Is that an Undership coming to her?', face='scared'),
 Father(u'And not just any Undership! Looks like my Nemesis and yours are coming to her aid!'),
 Kid(u'I see they don’t know her very well...', face='scared',
-    action=lambda game: [game.AddEnemy(ships.OtherBigShip(*OnEdge(0.3)), with_small_ship=True, final_battle=True),
-                         game.AddEnemy(ships.OtherBigShip(*OnEdge(0.3))),
-                        [game.AddEnemy(ships.JellyFish(*OnEdge(random.gauss(0.15, 0.03)))) for i in range(3)]]),
+    action=lambda game: [game.AddEnemy(ships.OtherBigShip(*OnEdge(game, 0.3)), with_small_ship=True, final_battle=True),
+                         game.AddEnemy(ships.OtherBigShip(*OnEdge(game, 0.3))),
+                        [game.AddEnemy(ships.JellyFish(*OnEdge(game, game.random.gauss(0.15, 0.03)))) for i in range(3)]]),
 
 AuntMenace(u'Your Nemesis is an even lousier captain than you are, Radîr!', trigger=Victory),
 AuntMenace(u'I’ve got to leave for now and search for adequate allies.'),
@@ -299,6 +306,8 @@ Group(u'', voice='thanks-for-playing'),
     self.paused = True
 
   def __init__(self):
+    # Lines get inserted when a ship is destroyed, so each game needs its own list.
+    self.dialog = list(Dialog.dialog)
     self.state = self.State('here-we-are')
     self.dialog[self.state].t = 0
     self.prev = Father('')
@@ -306,7 +315,7 @@ Group(u'', voice='thanks-for-playing'),
     self.paused = False
     self.textures = []
     Dialog.quad = rendering.Quad(1.0, 1.0)
-    self.background = rendering.Texture(pygame.image.load('art/dialog-background.png'))
+    self.background = rendering.TEXTURES.Get('art/dialog-background.png')
     pygame.font.init()
     Dialog.font = pygame.font.Font('OpenSans-Regular.ttf', 24)
     self.RenderText()
@@ -327,6 +336,8 @@ Group(u'', voice='thanks-for-playing'),
 
   def Update(self, dt, game):
     dialog = self.dialog[self.state]
+    if dialog.prefetch:
+      assets.Meshes.Prefetch(*dialog.prefetch)
 
     # animating dialogs for 0.25 sec (prev out, dialog in)
     if self.prev.t > 0:
@@ -339,7 +350,7 @@ Group(u'', voice='thanks-for-playing'),
         dialog.Speak()
 
     if self.paused:
-      for e in pygame.event.get():
+      for e in game.input.Events():
         if e.type == pygame.QUIT or e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE:
           pygame.quit()
           sys.exit(0)
@@ -0,0 +1,133 @@
+import numpy
+
+
+class EntityStore(object):
+  """Ship state kept in NumPy arrays, one row per ship.
+
+  Every ship gets a stable row id for as long as it lives, so whole-fleet
+  queries can run as array operations instead of Python loops. Rows of
+  released ships are reused.
+  """
+  FLOAT_COLUMNS = ('x', 'y', 'prev_x', 'prev_y', 'dx', 'dy', 'health', 'size')
+  INT_COLUMNS = ('faction',)
+
+  def __init__(self, capacity=64):
+    self.capacity = capacity
+    for name in self.FLOAT_COLUMNS:
+      setattr(self, name, numpy.zeros(capacity))
+    for name in self.INT_COLUMNS:
+      setattr(self, name, numpy.zeros(capacity, dtype=int))
+    self.alive = numpy.zeros(capacity, dtype=bool)
+    self.objects = [None] * capacity
+    self.free = []
+    self.used = 0
+
+  def Grow(self):
+    extra = self.capacity
+    for name in self.FLOAT_COLUMNS + self.INT_COLUMNS + ('alive',):
+      column = getattr(self, name)
+      setattr(self, name, numpy.concatenate(
+        [column, numpy.zeros(extra, dtype=column.dtype)]))
+    self.objects += [None] * extra
+    self.capacity += extra
+
+  def Allocate(self, obj):
+    if self.free:
+      i = self.free.pop()
+    else:
+      if self.used == self.capacity:
+        self.Grow()
+      i = self.used
+      self.used += 1
+    for name in self.FLOAT_COLUMNS + self.INT_COLUMNS:
+      getattr(self, name)[i] = 0
+    self.alive[i] = True
+    self.objects[i] = obj
+    return i
+
+  def Release(self, i):
+    self.alive[i] = False
+    self.objects[i] = None
+    self.free.append(i)
+
+  def Ids(self, mask=None):
+    """Returns the ids of the live entities, optionally filtered by mask.
+
+    mask is a boolean array over all rows, like store.faction != 1.
+    """
+    live = self.alive[:self.used]
+    if mask is not None:
+      live = live & mask[:self.used]
+    return numpy.flatnonzero(live)
+
+  def SavePositions(self):
+    self.prev_x[:] = self.x
+    self.prev_y[:] = self.y
+
+  def Nearest(self, x, y, mask=None):
+    """Returns the live entity closest to (x, y), or None."""
+    ids = self.Ids(mask)
+    if not len(ids):
+      return None
+    d = numpy.hypot(self.x[ids] - x, self.y[ids] - y)
+    return self.objects[ids[numpy.argmin(d)]]
+
+  def NearestIds(self, x, y, mask=None):
+    """Nearest for arrays of points. Returns row ids, there must be a live entity."""
+    ids = self.Ids(mask)
+    d = numpy.hypot(self.x[ids] - numpy.asarray(x)[:, None],
+                    self.y[ids] - numpy.asarray(y)[:, None])
+    return ids[numpy.argmin(d, axis=1)]
+
+  def Within(self, x, y, radius, mask=None):
+    """Returns the live entities whose centers are within radius of (x, y)."""
+    ids = self.Ids(mask)
+    d = numpy.hypot(self.x[ids] - x, self.y[ids] - y)
+    return [self.objects[i] for i in ids[d <= radius]]
+
+
+class Column(object):
+  """An attribute of an entity that lives in its EntityStore row.
+
+  Once an entity is released, its last values stay readable and writable,
+  so stale references (like a projectile's owner) keep working.
+  """
+
+  def __init__(self, name):
+    self.name = name
+
+  def __get__(self, obj, cls):
+    if obj is None:
+      return self
+    if obj.entity_id is None:
+      return obj.detached[self.name]
+    return getattr(obj.store, self.name).item(obj.entity_id)
+
+  def __set__(self, obj, value):
+    if obj.entity_id is None:
+      obj.detached[self.name] = value
+    else:
+      getattr(obj.store, self.name)[obj.entity_id] = value
+
+
+class Entity(object):
+  """Base class for objects whose state is kept in an EntityStore.
+
+  Subclasses set the class attribute 'store'. Each object keeps the store
+  that was current when it was created.
+  """
+  store = None
+
+  def __init__(self):
+    self.store = self.__class__.store
+    self.entity_id = self.store.Allocate(self)
+
+  def Release(self):
+    if self.entity_id is None:
+      return
+    store = self.store
+    self.detached = dict(
+      (name, getattr(self, name))
+      for name in store.FLOAT_COLUMNS + store.INT_COLUMNS)
+    store.Release(self.entity_id)
+    self.entity_id = None
@@ -0,0 +1,130 @@
+import ctypes
+import numpy
+from OpenGL.GL import *
+
+import rendering
+
+# Floats per vertex: x, y, z, r, g, b, a.
+STRIDE = 7
+
+
+class Stream(object):
+  """Collects untextured, coloured geometry and draws it in few calls.
+
+  Callers Add vertex and colour arrays under a primitive mode and Flush
+  once they have added everything that is drawn with the same GL state.
+  Vertices from all Add calls of a mode are drawn with one glDrawArrays,
+  so only list primitives (GL_TRIANGLES, GL_LINES, GL_POINTS) can be used.
+
+  The vertices go into a ring buffer. Each flush writes behind the previous
+  one, and when the buffer is full it is orphaned and refilled from the
+  start, so the driver never has to wait for a draw still using the data.
+  """
+
+  def __init__(self, capacity=16384):
+    self.capacity = capacity  # In vertices.
+    self.vbo = None
+    self.offset = 0
+    self.pending = {}  # mode -> list of packed arrays
+
+  def Add(self, mode, vertices, colors):
+    """vertices are (n, 2) or (n, 3), colors (n, 4) or a single colour."""
+    if not rendering.HEADLESS:
+      self.AddPacked(mode, Pack(vertices, colors))
+
+  def AddPacked(self, mode, data):
+    """Adds vertices already packed with Pack."""
+    if not rendering.HEADLESS:
+      self.pending.setdefault(mode, []).append(data)
+
+  def Flush(self, mode=None):
+    """Draws what was added under mode, or under every mode if None."""
+    modes = self.pending.keys() if mode is None else [mode]
+    for mode in modes:
+      arrays = self.pending.pop(mode, None)
+      if arrays:
+        self.Draw(mode, numpy.concatenate(arrays))
+
+  def Draw(self, mode, data):
+    n = len(data)
+    if not n:
+      return
+    if self.vbo is None:
+      self.vbo = glGenBuffers(1)
+      self.offset = self.capacity
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    if self.offset + n > self.capacity:
+      while n > self.capacity:
+        self.capacity *= 2
+      glBufferData(GL_ARRAY_BUFFER, self.capacity * data.itemsize * STRIDE, None, GL_STREAM_DRAW)
+      self.offset = 0
+    glBufferSubData(GL_ARRAY_BUFFER, self.offset * data.itemsize * STRIDE, data.nbytes, data)
+    DrawBound(mode, self.offset, n)
+    self.offset += n
+
+
+class Batch(object):
+  """Geometry that rarely changes, kept in its own buffer.
+
+  Set uploads new contents, Draw draws whatever was uploaded last.
+  """
+
+  def __init__(self):
+    self.vbo = None
+    self.count = 0
+
+  def Set(self, data):
+    """Takes an (n, STRIDE) array made by Pack."""
+    self.count = len(data)
+    if rendering.HEADLESS or not self.count:
+      return
+    if self.vbo is None:
+      self.vbo = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    glBufferData(GL_ARRAY_BUFFER, data.nbytes, data, GL_STATIC_DRAW)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+  def Draw(self, mode):
+    if rendering.HEADLESS or not self.count:
+      return
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    DrawBound(mode, 0, self.count)
+
+
+def DrawBound(mode, first, count):
+  """Draws packed vertices from the bound buffer, then unbinds it."""
+  F = ctypes.sizeof(ctypes.c_float)
+  FP = lambda x: ctypes.cast(x * F, ctypes.POINTER(ctypes.c_float))
+  glEnableClientState(GL_VERTEX_ARRAY)
+  glEnableClientState(GL_COLOR_ARRAY)
+  glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+  glVertexPointer(3, GL_FLOAT, STRIDE * F, FP(0))
+  glColorPointer(4, GL_FLOAT, STRIDE * F, FP(3))
+  glDrawArrays(mode, first, count)
+  glDisableClientState(GL_COLOR_ARRAY)
+  glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+
+def Pack(vertices, colors):
+  """Interleaves (n, 2) or (n, 3) vertices with (n, 4) or single colours."""
+  vertices = numpy.asarray(vertices, dtype=numpy.float32)
+  data = numpy.zeros((len(vertices), STRIDE), dtype=numpy.float32)
+  data[:, :vertices.shape[1]] = vertices
+  data[:, 3:] = colors
+  return data
+
+
+def Quads(corners):
+  """Turns (n, 4, ...) quad corners into (n * 6, ...) triangle vertices."""
+  return corners[:, [0, 1, 2, 0, 2, 3]].reshape((-1,) + corners.shape[2:])
+
+
+def Strip(vertices):
+  """Turns triangle strip vertices into triangle list vertices."""
+  if len(vertices) < 3:
+    return vertices[:0]
+  i = numpy.arange(len(vertices) - 2)
+  return vertices[numpy.column_stack([i, i + 1, i + 2]).ravel()]
+
+
+STREAM = Stream()
@@ -0,0 +1,88 @@
+"""Runs the game simulation without a window or OpenGL, as fast as possible.
+
+Used for balance and regression runs on machines without a GPU:
+
+  python headless.py --frames 20000 --runs 10 --quiet
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+import pygame
+
+import rendering
+import run_game
+
+
+class HeadlessInput(object):
+  """Input source that clicks through the dialog and otherwise stays idle."""
+
+  def __init__(self, game):
+    self.game = game
+
+  def Events(self):
+    if self.game.dialog.paused:
+      return [pygame.event.Event(pygame.KEYDOWN, key=pygame.K_SPACE, unicode=u' ')]
+    return []
+
+  def MousePosition(self):
+    return (0, 0)
+
+  def PressedKeys(self):
+    return collections.defaultdict(bool)
+
+
+def Autopilot(game):
+  """Lets the computer play the father and the Needle so the story moves on."""
+  game.father_ship.AI = 'Chasing shapes'
+  game.needle_ship.AI = 'Evil Needle'
+  # The tutorial only spawns crystals once the player has drawn a few paths.
+  # The Evil Needle needs them to move at all.
+  game.crystals.SetState('KeepMax')
+
+
+def Run(frames, dt, autopilot=True, seed=None):
+  rendering.HEADLESS = True
+  game = run_game.Game(seed=seed)
+  game.input = HeadlessInput(game)
+  game.InitGame()
+  if autopilot:
+    Autopilot(game)
+  start = time.time()
+  for i in xrange(frames):
+    game.Step(dt)
+  return game, time.time() - start
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Run the simulation headless.')
+  parser.add_argument('--frames', type=int, default=10000,
+                      help='simulation steps per run')
+  parser.add_argument('--dt', type=float, default=1 / 60.,
+                      help='seconds of game time per step')
+  parser.add_argument('--runs', type=int, default=1)
+  parser.add_argument('--seed', type=int, default=None,
+                      help='random seed of the first run, later runs count up')
+  parser.add_argument('--no-autopilot', dest='autopilot', action='store_false',
+                      help='leave the father and the Needle idle')
+  parser.add_argument('--quiet', action='store_true',
+                      help='hide the game\'s own output while it runs')
+  args = parser.parse_args()
+
+  for run in xrange(args.runs):
+    stdout = sys.stdout
+    if args.quiet:
+      sys.stdout = open(os.devnull, 'w')
+    try:
+      seed = None if args.seed is None else args.seed + run
+      game, seconds = Run(args.frames, args.dt, args.autopilot, seed)
+    finally:
+      sys.stdout = stdout
+    print ('run %i: %i frames (%.1f s game time) in %.2f s, %.0f frames/s, '
+           '%i ships, father mana %.0f, dialog line %i'
+           % (run, args.frames, game.time, seconds, args.frames / seconds,
+              len(game.ships), game.father_ship.mana, game.dialog.state))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,109 @@
+import numpy
+
+import ships
+
+
+class PathManager(object):
+  """Evaluates the ShipPaths of many objects at once.
+
+  The segments of all paths are packed into one set of arrays, rebuilt only
+  when an object gets a new path. Each frame, positions, velocities and
+  segment indices for every object come out of a few array operations.
+  The results match calling each ShipPath on its own.
+  """
+
+  def __init__(self):
+    self.objects = []
+    self.keys = []
+    self.Pack([])
+
+  def Sync(self, objects):
+    """Takes the objects to move. Their path_func must be ShipPaths."""
+    keys = [(id(obj.path_func), obj.path_func_start_time) for obj in objects]
+    if keys != self.keys or objects != self.objects:
+      self.objects = list(objects)
+      self.keys = keys
+      self.Pack([(obj.path_func, obj.path_func_start_time) for obj in objects])
+
+  def Pack(self, paths):
+    n = len(paths)
+    self.start_time = numpy.array([t for p, t in paths], dtype=float)
+    self.velocity = numpy.array([p.max_velocity for p, t in paths], dtype=float)
+    self.total_distance = numpy.array([p.total_distance for p, t in paths], dtype=float)
+    self.total_time = numpy.array([p.total_time for p, t in paths], dtype=float)
+    self.start = numpy.array([p.start for p, t in paths], dtype=float).reshape(n, 2)
+    self.direction = numpy.array([p.direction for p, t in paths], dtype=float).reshape(n, 2)
+    # The last waypoint, where finished paths stay.
+    self.end = numpy.array([p.waypoints[-1] for p, t in paths], dtype=float).reshape(n, 2)
+    self.count = numpy.array([len(p.segments) for p, t in paths], dtype=int)
+    self.offset = numpy.concatenate([[0], numpy.cumsum(self.count)[:-1]]).astype(int)
+    segments = [s for p, t in paths for s in p.segments]
+    self.seg_row = numpy.repeat(numpy.arange(n), self.count)
+    self.seg_start = numpy.array([s[0] for s in segments], dtype=float).reshape(-1, 2)
+    self.seg_end = numpy.array([s[1] for s in segments], dtype=float).reshape(-1, 2)
+    self.seg_length = numpy.array([s[2] for s in segments], dtype=float)
+    self.seg_cumulative = numpy.array([c for p, t in paths for c in p.cumulative], dtype=float)
+    self.seg_ends = numpy.array([e for p, t in paths for e in p.ends], dtype=float)
+
+  def Evaluate(self, time):
+    """Returns x, y, dx, dy, segment index and finished flags, one per object.
+
+    Finished objects stay at their last waypoint. Their dx and dy are NaN,
+    where a ShipPath returns None. Paths of length zero never finish and
+    have an index of -1, where a ShipPath returns None.
+    """
+    n = len(self.objects)
+    t = time - self.start_time
+    total = self.total_distance
+    moving = total != 0
+    safe_total = numpy.where(moving, total, 1)
+    safe_time = numpy.where(moving, self.total_time, 1)
+    before = t < 0
+    finished = moving & (t > self.total_time)
+    distance = numpy.where(before, 0, numpy.where(finished, total, t / safe_time * total))
+    velocity = numpy.where(before | finished, 0, self.velocity)
+    # The same steps as ShipPath.__call__ and Curve, for the same rounding.
+    distance = distance / safe_total * total
+
+    # Segments of each path that end at or before the distance travelled.
+    passed = self.seg_ends <= distance[self.seg_row]
+    index = numpy.bincount(self.seg_row, weights=passed, minlength=n).astype(int)
+    past_end = index >= self.count
+    g = numpy.minimum(self.offset + index, max(len(self.seg_length) - 1, 0))
+    if len(self.seg_length):
+      start, end = self.seg_start[g], self.seg_end[g]
+      # Only segments past the end can have length zero; they are not used.
+      length = numpy.where(self.seg_length[g] == 0, 1, self.seg_length[g])
+      small = (distance - self.seg_cumulative[g]) / length
+      location = start + (end - start) * small[:, None]
+      direction = (end - start) / length[:, None]
+    else:
+      location = direction = numpy.zeros((n, 2))
+    location = numpy.where(past_end[:, None], self.end, location)
+    direction = numpy.where(past_end[:, None], 0, direction)
+
+    turn = ships.ShipPath.seconds_to_turn
+    ratio = numpy.maximum(turn - t, 0) / turn
+    turning = ratio > 0
+    ox, oy = self.direction[:, 0], self.direction[:, 1]
+    dx, dy = direction[:, 0], direction[:, 1]
+    dot = dx * ox + dy * oy
+    reversing = turning & (dot < -0.9)
+    with numpy.errstate(invalid='ignore'):
+      rad = numpy.arccos(dot) * ratio
+    cos, sin = numpy.cos(rad), numpy.sin(rad)
+    rx, ry = dx * cos + dy * sin, -dx * sin + dy * cos
+    bx = ox * ratio + dx * (1 - ratio)
+    by = oy * ratio + dy * (1 - ratio)
+    dx = numpy.where(reversing, rx, numpy.where(turning, bx, dx))
+    dy = numpy.where(reversing, ry, numpy.where(turning, by, dy))
+
+    x = numpy.where(moving, location[:, 0], self.start[:, 0])
+    y = numpy.where(moving, location[:, 1], self.start[:, 1])
+    dx = numpy.where(moving, dx * velocity, 0)
+    dy = numpy.where(moving, dy * velocity, 0)
+    dx[finished] = numpy.nan
+    dy[finished] = numpy.nan
+    index = numpy.where(moving, index, -1)
+    return x, y, dx, dy, index, finished
+
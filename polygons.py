@@ -0,0 +1,184 @@
+import collections
+import heapq
+import math
+import numpy
+
+import shapes
+
+
+class PolygonIndex(object):
+  """Near-regular polygons among the crystals that can still form shapes.
+
+  A crystal is available while it is visible and not in a shape. When one
+  becomes available, its nearest available neighbours give edges, so the
+  reach follows how densely the crystals lie. Walking around from each edge
+  with the turn of each polygon kind predicts where the other corners
+  should be, and the crystal index is asked for a crystal near each
+  prediction. Polygons are keyed by kind and the set of their crystal ids,
+  so the rotations and reflections of one polygon are stored once. Each
+  crystal keeps only its best few polygons of each kind, which keeps the
+  number of polygons and the cost of adding a crystal flat as the field
+  fills up. Polygons go away when one of their crystals stops being
+  available, or when a better one pushes them out.
+
+  Best returns the highest scoring polygon from a heap. Entries of removed
+  polygons stay in the heap and are skipped when they come up.
+  """
+  # name -> (number of corners, turn at each corner in degrees)
+  kinds = {
+    'triangle': (3, 120),
+    'square': (4, 90),
+    'pentagon': (5, 72),
+    'pentagram': (5, 144),
+  }
+
+  def __init__(self, crystals, max_side=0.6, tolerance=0.2, neighbours=8, per_crystal=3):
+    """max_side is the longest side looked for, and sides only go to the
+    nearest neighbours of a crystal. A corner may be off from where it
+    should be by tolerance times the side length. Each crystal keeps its
+    best per_crystal polygons of each kind."""
+    self.crystals = crystals
+    self.max_side = max_side
+    self.tolerance = tolerance
+    self.neighbours = neighbours
+    self.per_crystal = per_crystal
+    self.available = {}  # crystal id -> crystal
+    self.polygons = {}  # (kind, crystal ids) -> (score, path)
+    self.by_crystal = collections.defaultdict(set)  # crystal id -> keys
+    self.heap = []
+
+  def __len__(self):
+    return len(self.polygons)
+
+  @staticmethod
+  def IsAvailable(crystal):
+    return crystal.visible and not crystal.in_shape
+
+  def Sync(self, crystal):
+    """Adds or removes a crystal whose availability may have changed."""
+    available = self.IsAvailable(crystal)
+    if available and crystal.id not in self.available:
+      self.Add(crystal)
+    elif not available and crystal.id in self.available:
+      self.Remove(crystal)
+
+  def Add(self, crystal):
+    self.available[crystal.id] = crystal
+    found = {}
+    for other in self.Nearest(crystal):
+      for kind, (corners, turn) in self.kinds.iteritems():
+        for direction in (1, -1):
+          path = self.Trace(crystal, other, corners, math.radians(turn * direction))
+          if path:
+            key = (kind,) + tuple(sorted(c.id for c in path))
+            if key not in self.polygons:
+              found[key] = path
+    if found:
+      keys = sorted(found)
+      paths = [found[key] for key in keys]
+      corners = numpy.zeros((len(paths), max(len(path) for path in paths), 2))
+      for i, path in enumerate(paths):
+        corners[i, :len(path)] = [(c.x, c.y) for c in path]
+      scores = shapes.ShapeScores(corners, [len(path) for path in paths])
+      for score, key, path in sorted(zip(scores.tolist(), keys, paths), reverse=True):
+        self.Insert(key, path, score)
+
+  def Remove(self, crystal):
+    self.available.pop(crystal.id, None)
+    for key in list(self.by_crystal.get(crystal.id, ())):
+      self.Discard(key)
+    self.by_crystal.pop(crystal.id, None)
+
+  def Discard(self, key):
+    score, path = self.polygons.pop(key)
+    for crystal in path:
+      self.by_crystal[crystal.id].discard(key)
+
+  def Near(self, x, y, radius):
+    """Available crystals within radius of (x, y)."""
+    return [c for c in self.crystals.Query(x, y, radius)
+            if c.id in self.available and c.DistanceFromCoord(x, y) <= radius]
+
+  def Nearest(self, crystal):
+    """The nearest available neighbours of crystal, up to max_side away.
+
+    The search starts at twice the mean spacing of the available crystals
+    and grows until it has found enough of them.
+    """
+    c = self.crystals
+    area = (c.max_x - c.min_x) * (c.max_y - c.min_y)
+    radius = min(2 * math.sqrt(area / len(self.available)), self.max_side)
+    while True:
+      near = sorted((c.DistanceFromCoord(crystal.x, crystal.y), c.id, c)
+                    for c in self.Near(crystal.x, crystal.y, radius) if c is not crystal)
+      if len(near) >= self.neighbours or radius >= self.max_side:
+        return [c for d, i, c in near[:self.neighbours]]
+      radius = min(2 * radius, self.max_side)
+
+  def Trace(self, first, second, corners, turn):
+    """Returns the corners of a polygon starting with the edge first-second,
+    or None if crystals are missing where the other corners should be."""
+    side = first.DistanceFromCoord(second.x, second.y)
+    if side == 0:
+      return None
+    cos, sin = math.cos(turn), math.sin(turn)
+    reach = self.tolerance * side
+    path = [first, second]
+    x, y = second.x, second.y
+    dx, dy = second.x - first.x, second.y - first.y
+    for i in xrange(corners - 1):
+      dx, dy = dx * cos - dy * sin, dx * sin + dy * cos
+      x, y = x + dx, y + dy
+      if i == corners - 2:
+        # Back at the start?
+        if first.DistanceFromCoord(x, y) > reach:
+          return None
+        break
+      candidates = [c for c in self.Near(x, y, reach) if c not in path]
+      if not candidates:
+        return None
+      corner = min(candidates, key=lambda c: c.DistanceFromCoord(x, y))
+      path.append(corner)
+      # Continue from the crystal, not the prediction, like a player would.
+      dx, dy = corner.x - path[-2].x, corner.y - path[-2].y
+      x, y = corner.x, corner.y
+    return path
+
+  def Insert(self, key, path, score):
+    """Adds a polygon, then drops the worst polygons of its kind from
+    crystals that have more than per_crystal of them."""
+    self.polygons[key] = score, path
+    for crystal in path:
+      self.by_crystal[crystal.id].add(key)
+    heapq.heappush(self.heap, (-score, key))
+    if len(self.heap) > 2 * len(self.polygons) + 64:
+      self.heap = [(-score, key) for key, (score, path) in self.polygons.iteritems()]
+      heapq.heapify(self.heap)
+    for crystal in path:
+      same = [k for k in self.by_crystal[crystal.id] if k[0] == key[0]]
+      if len(same) > self.per_crystal:
+        worst = min(same, key=lambda k: (self.polygons[k][0], k))
+        self.Discard(worst)
+        if worst == key:
+          return
+
+  def Best(self):
+    """Returns (score, path) of the best available polygon, or None.
+
+    The path does not repeat the first crystal at the end.
+    """
+    while self.heap:
+      score, key = self.heap[0]
+      if key not in self.polygons or self.polygons[key][0] != -score:
+        # Removed, or removed and found again with another score.
+        heapq.heappop(self.heap)
+        continue
+      path = self.polygons[key][1]
+      # Crystals can be taken between two syncs.
+      stale = [c for c in path if not self.IsAvailable(c)]
+      if stale:
+        for crystal in stale:
+          self.Remove(crystal)
+        continue
+      return -score, list(path)
+    return None
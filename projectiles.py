@@ -0,0 +1,156 @@
+import math
+import numpy
+from OpenGL.GL import *
+
+import rendering
+
+
+class ProjectilePool(object):
+  """All projectiles in flight, stored in fixed-size arrays.
+
+  Slots are reused, so firing does not allocate anything. All live
+  projectiles share one texture and are drawn with a single draw call.
+  """
+  size = 0.075
+  damage = 0.5
+  max_velocity = 1.2
+  lifetime = 0.5
+  texture = None
+
+  def __init__(self, capacity=256):
+    self.capacity = capacity
+    self.x = numpy.zeros(capacity)
+    self.y = numpy.zeros(capacity)
+    self.prev_x = numpy.zeros(capacity)
+    self.prev_y = numpy.zeros(capacity)
+    # Projectiles fly straight from the origin at a constant velocity until
+    # the flight time is over, then stay put until they expire.
+    self.origin_x = numpy.zeros(capacity)
+    self.origin_y = numpy.zeros(capacity)
+    self.vx = numpy.zeros(capacity)
+    self.vy = numpy.zeros(capacity)
+    self.spawn_time = numpy.zeros(capacity)
+    self.flight_time = numpy.zeros(capacity)
+    self.expire_time = numpy.zeros(capacity)
+    self.faction = numpy.zeros(capacity, dtype=int)
+    self.alive = numpy.zeros(capacity, dtype=bool)
+    self.owners = [None] * capacity
+    self.free = range(capacity - 1, -1, -1)
+    self.vbo = None
+
+  def __len__(self):
+    return self.capacity - len(self.free)
+
+  def LiveIds(self):
+    return numpy.flatnonzero(self.alive)
+
+  def Spawn(self, owner, target_x, target_y, time):
+    """Fires a projectile from owner towards the target.
+
+    The projectile stops at the target. It expires after its lifetime, or
+    once it is further from where it was fired than the owner's combat
+    range. Returns False if the pool is full and nothing was fired.
+    """
+    if not self.free:
+      return False
+    i = self.free.pop()
+    self.x[i] = self.prev_x[i] = self.origin_x[i] = owner.x
+    self.y[i] = self.prev_y[i] = self.origin_y[i] = owner.y
+    distance = math.hypot(target_x - owner.x, target_y - owner.y)
+    reach = owner.combat_range + (self.size + owner.size) / 3.0
+    if distance:
+      self.vx[i] = (target_x - owner.x) / distance * self.max_velocity
+      self.vy[i] = (target_y - owner.y) / distance * self.max_velocity
+    else:
+      self.vx[i] = self.vy[i] = 0
+    self.spawn_time[i] = time
+    self.flight_time[i] = min(distance, reach) / self.max_velocity
+    if distance > reach:
+      self.expire_time[i] = time + min(self.lifetime, self.flight_time[i])
+    else:
+      self.expire_time[i] = time + self.lifetime
+    self.faction[i] = owner.faction
+    self.alive[i] = True
+    self.owners[i] = owner
+    return True
+
+  def Kill(self, i):
+    self.alive[i] = False
+    self.owners[i] = None
+    self.free.append(i)
+
+  def SavePositions(self):
+    self.prev_x[:] = self.x
+    self.prev_y[:] = self.y
+
+  def Move(self, ids, time):
+    """Puts the given projectiles where they are at the given time."""
+    t = numpy.clip(time - self.spawn_time[ids], 0, self.flight_time[ids])
+    self.x[ids] = self.origin_x[ids] + self.vx[ids] * t
+    self.y[ids] = self.origin_y[ids] + self.vy[ids] * t
+
+  def Update(self, game):
+    """Moves the projectiles and applies damage to the ships they hit.
+
+    A projectile hits a ship if any point it passed since the last update
+    came close enough, so fast projectiles cannot skip over a ship.
+    """
+    for i in self.LiveIds():
+      if self.owners[i].entity_id is None:
+        self.Kill(i)
+    ids = self.LiveIds()
+    self.Move(ids, game.time)
+    for i in ids:
+      x0, y0 = self.prev_x.item(i), self.prev_y.item(i)
+      x1, y1 = self.x.item(i), self.y.item(i)
+      sx, sy = x1 - x0, y1 - y0
+      length2 = sx * sx + sy * sy
+      half = math.sqrt(length2) / 2
+      faction = self.faction.item(i)
+      for enemy in game.ship_grid.Query(x0 + sx / 2, y0 + sy / 2, self.size + half):
+        if enemy.faction == faction:
+          continue
+        # Closest point of the swept segment to the ship.
+        ex, ey = enemy.x - x0, enemy.y - y0
+        u = min(max((ex * sx + ey * sy) / length2, 0), 1) if length2 else 0
+        reach = (enemy.size + self.size) / 3.0 + (enemy.size + self.size) / 2
+        if math.hypot(ex - sx * u, ey - sy * u) < reach:
+          enemy.health -= game.random.gauss(self.damage, 0.1)
+          self.Kill(i)
+          break
+    for i in numpy.flatnonzero(self.alive & (self.expire_time < game.time)):
+      self.Kill(i)
+
+  def Render(self, alpha=1.0):
+    ids = self.LiveIds()
+    if not len(ids):
+      return
+    # Loaded here, as the pool is made before there is a GL context.
+    if ProjectilePool.texture is None:
+      ProjectilePool.texture = rendering.TEXTURES.Get('art/ships/balls.png')
+    x = self.prev_x[ids] + (self.x[ids] - self.prev_x[ids]) * alpha
+    y = self.prev_y[ids] + (self.y[ids] - self.prev_y[ids]) * alpha
+    # One textured quad per projectile: x, y, z, u, v for each corner.
+    s = self.size / 2
+    corners = numpy.array([[-s, -s, 0, 0, 0],
+                           [s, -s, 0, 1, 0],
+                           [s, s, 0, 1, 1],
+                           [-s, s, 0, 0, 1]], dtype=numpy.float32)
+    buf = numpy.tile(corners, (len(ids), 1, 1))
+    buf[:, :, 0] += x[:, None]
+    buf[:, :, 1] += y[:, None]
+
+    F = ctypes.sizeof(ctypes.c_float)
+    FP = lambda x: ctypes.cast(x * F, ctypes.POINTER(ctypes.c_float))
+    if self.vbo is None:
+      self.vbo = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    glBufferData(GL_ARRAY_BUFFER, buf.nbytes, buf, GL_STREAM_DRAW)
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+    glVertexPointer(3, GL_FLOAT, 5 * F, FP(0))
+    glTexCoordPointer(2, GL_FLOAT, 5 * F, FP(3))
+    glColor(1, 1, 1, 1)
+    with self.texture:
+      glDrawArrays(GL_QUADS, 0, 4 * len(ids))
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
@@ -1,15 +1,30 @@
+import collections
+import hashlib
 import math
+import numpy
+import os
 import pygame
+import re
+import struct
 from OpenGL.GL import *
 
 import assets
+import geometry
 
 WIDTH, HEIGHT = 900.0, 600.0
 RATIO = WIDTH / HEIGHT
 
+# When set, no OpenGL calls are made and no image or model files are read.
+# Buffers, textures and meshes become empty placeholders so the simulation
+# can run without a window. Must be set before any of them are created.
+HEADLESS = False
+
 class Quad(object):
 
   def __init__(self, w, h):
+    self.id = None
+    if HEADLESS:
+      return
     self.buf = (ctypes.c_float * (4 * 5))()
     for i, x in enumerate([-w/2, -h/2, 0, 0, 0, w/2, -h/2, 0, 1, 0, w/2, h/2, 0, 1, 1, -w/2, h/2, 0, 0, 1]):
       self.buf[i] = x
@@ -27,40 +42,102 @@ class Quad(object):
     glTexCoordPointer(2, GL_FLOAT, 5 * F, FP(3))
     glDrawArrays(GL_QUADS, 0, 4)
 
-  def RenderCrystal(self, alpha=1, highlighted=False):
+
+class CrystalBatch(object):
+  """Draws every visible crystal with one buffer upload and one draw call.
+
+  Position, alpha and highlight are repeated on the four corners of each
+  quad, so the crystal shader gets them as vertex attributes instead of
+  per-crystal uniforms.
+  """
+
+  def __init__(self, w, h):
+    self.vbo = None
+    # x, y, z, u, v of each corner, before moving it to the crystal.
+    self.corners = numpy.array([[-w/2, -h/2, 0, 0, 0],
+                                [w/2, -h/2, 0, 1, 0],
+                                [w/2, h/2, 0, 1, 1],
+                                [-w/2, h/2, 0, 0, 1]], dtype=numpy.float32)
+
+  def Render(self, x, y, alpha, highlighted):
+    """Takes one array entry per crystal."""
+    n = len(x)
+    if HEADLESS or not n:
+      return
+    # x, y, z, u, v, alpha, highlight for each corner.
+    buf = numpy.empty((n, 4, 7), dtype=numpy.float32)
+    buf[:, :, :5] = self.corners
+    buf[:, :, 0] += numpy.asarray(x, dtype=numpy.float32)[:, None]
+    buf[:, :, 1] += numpy.asarray(y, dtype=numpy.float32)[:, None]
+    buf[:, :, 5] = numpy.asarray(alpha, dtype=numpy.float32)[:, None]
+    buf[:, :, 6] = numpy.asarray(highlighted, dtype=numpy.float32)[:, None]
+
     F = ctypes.sizeof(ctypes.c_float)
     FP = lambda x: ctypes.cast(x * F, ctypes.POINTER(ctypes.c_float))
-    glBindBuffer(GL_ARRAY_BUFFER, self.id)
+    if self.vbo is None:
+      self.vbo = glGenBuffers(1)
+    program = assets.CRYSTAL_PROGRAM
+    fade = program.Attribute('fade')
+    glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
+    glBufferData(GL_ARRAY_BUFFER, buf.nbytes, buf, GL_STREAM_DRAW)
     glEnableClientState(GL_VERTEX_ARRAY)
     glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+    glVertexPointer(3, GL_FLOAT, 7 * F, FP(0))
+    glTexCoordPointer(2, GL_FLOAT, 7 * F, FP(3))
+    glEnableVertexAttribArray(fade)
+    glVertexAttribPointer(fade, 2, GL_FLOAT, GL_FALSE, 7 * F, ctypes.c_void_p(5 * F))
+
+    with program:
+      glEnable(GL_TEXTURE_2D)
+      glActiveTexture(GL_TEXTURE0)
+      glBindTexture(GL_TEXTURE_2D, assets.CRYSTAL_TEXTURE)
+      program.Set('crystal_tex', 0)
+      glDrawArrays(GL_QUADS, 0, 4 * n)
+
+    glDisableVertexAttribArray(fade)
+    glActiveTexture(GL_TEXTURE0)
+    glBindTexture(GL_TEXTURE_2D, 0)
+    glDisable(GL_TEXTURE_2D)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
 
-    glUseProgram(assets.CRYSTAL_PROGRAM)
-    glEnable(GL_TEXTURE_2D)
 
-    location = glGetUniformLocation(assets.CRYSTAL_PROGRAM, 'alpha')
-    glUniform1f(location, alpha)
+# Decoded pixels, ready for upload. Can be made on any thread.
+Image = collections.namedtuple('Image', 'data width height')
 
-    glActiveTexture(GL_TEXTURE0)
-    glBindTexture(GL_TEXTURE_2D, assets.CRYSTAL_TEXTURE)
-    location = glGetUniformLocation(assets.CRYSTAL_PROGRAM, 'crystal_tex')
-    glUniform1i(location, 0)
 
-    glVertexPointer(3, GL_FLOAT, 5 * F, FP(0))
-    glTexCoordPointer(2, GL_FLOAT, 5 * F, FP(3))
-    glDrawArrays(GL_QUADS, 0, 4)
+def LoadSurface(filename):
+  if HEADLESS:
+    return None
+  return pygame.image.load(filename)
 
-    glUseProgram(0)
-    glActiveTexture(GL_TEXTURE0)
-    glBindTexture(GL_TEXTURE_2D, 0)
-    glDisable(GL_TEXTURE_2D)
+
+def LoadImage(filename, flipped=True):
+  surface = LoadSurface(filename)
+  if surface is None:
+    return None
+  return Image(pygame.image.tostring(surface, 'RGBA', flipped),
+               surface.get_width(), surface.get_height())
+
+
+def LoadTexture(filename, mipmap=False):
+  return Texture(LoadSurface(filename), mipmap=mipmap)
 
 
 class Texture(object):
   def __init__(self, surface, mipmap=False):
-    data = pygame.image.tostring(surface, 'RGBA', 1)
+    """surface is a pygame Surface or an Image."""
+    if HEADLESS:
+      self.id = None
+      self.width = self.height = 0
+      self.bytes = 0
+      return
+    if isinstance(surface, Image):
+      data, self.width, self.height = surface
+    else:
+      data = pygame.image.tostring(surface, 'RGBA', 1)
+      self.width = surface.get_width()
+      self.height = surface.get_height()
     self.id = glGenTextures(1)
-    self.width = surface.get_width()
-    self.height = surface.get_height()
     glBindTexture(GL_TEXTURE_2D, self.id)
     if mipmap:
       glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER,
@@ -72,10 +149,13 @@ class Texture(object):
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP)
     glTexParameter(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP)
     glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height, 0, GL_RGBA, GL_UNSIGNED_BYTE, data)
+    # Video memory estimate. Mipmaps add a third.
+    self.bytes = self.width * self.height * 4 * (4 / 3. if mipmap else 1)
     self.width /= HEIGHT / 2
     self.height /= HEIGHT / 2
   def Delete(self):
-    glDeleteTextures(self.id)
+    if self.id is not None:
+      glDeleteTextures(self.id)
   def __enter__(self):
     glBindTexture(GL_TEXTURE_2D, self.id)
     glEnable(GL_TEXTURE_2D)
@@ -86,121 +166,254 @@ class Texture(object):
     glDisable(GL_TEXTURE_2D)
 
 
-def DrawPath(path):
-  glBegin(GL_TRIANGLE_STRIP)
-  lx = ly = None
-  for x, y in path:
-    if lx is None:
-      glVertex(x, y, 0)
+class TextureCache(object):
+  """Textures loaded from files, shared by everyone using the same file.
+
+  Get returns the texture and takes a reference, Release gives it back.
+  Textures nobody references stay loaded until the estimated video memory
+  use goes over budget. Then the least recently used ones are deleted.
+  """
+
+  def __init__(self, budget=64 * 1024 * 1024):
+    self.budget = budget
+    # (filename, mipmap) -> [texture, references], least recently used first.
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.bytes_resident = 0
+
+  def Get(self, filename, mipmap=False, image=None):
+    """Returns the texture for a file. image is used if it is not loaded yet."""
+    key = (filename, mipmap)
+    entry = self.entries.pop(key, None)
+    if entry:
+      self.hits += 1
     else:
-      dx = x - lx
-      dy = y - ly
-      hypot = math.hypot(dx, dy)
-      if hypot != 0:
-        n = 0.005 / hypot
-        dx *= n
-        dy *= n
-        glVertex(x + dy, y - dx, 0)
-        glVertex(x - dy, y + dx, 0)
-    lx = x
-    ly = y
-  glEnd()
+      self.misses += 1
+      texture = Texture(image or LoadSurface(filename), mipmap=mipmap)
+      texture.cache_key = key
+      self.bytes_resident += texture.bytes
+      entry = [texture, 0]
+    entry[1] += 1
+    self.entries[key] = entry
+    self.Evict()
+    return entry[0]
+
+  def Release(self, texture):
+    entry = self.entries.get(texture.cache_key)
+    if entry and entry[0] is texture:
+      entry[1] -= 1
+      self.Evict()
+
+  def Evict(self):
+    for key in self.entries.keys():
+      if self.bytes_resident <= self.budget:
+        break
+      texture, references = self.entries[key]
+      if references == 0:
+        del self.entries[key]
+        self.bytes_resident -= texture.bytes
+        texture.Delete()
+
+  def __str__(self):
+    return 'textures: %i (%.1f MB), %i hits, %i misses' % (
+      len(self.entries), self.bytes_resident / 1048576., self.hits, self.misses)
+
+TEXTURES = TextureCache()
+
+
+def DrawPath(path, color=(1, 1, 1, 1)):
+  """Draws the mouse path as a thin ribbon."""
+  if len(path) < 2:
+    return
+  points = numpy.array(path, dtype=float)
+  d = points[1:] - points[:-1]
+  hypot = numpy.hypot(d[:, 0], d[:, 1])
+  moved = hypot != 0
+  # Offsets to the two sides of each point, 0.005 from the centre line.
+  normal = d[moved] * (0.005 / hypot[moved])[:, None]
+  side = numpy.column_stack([normal[:, 1], -normal[:, 0]])
+  centre = points[1:][moved]
+  strip = numpy.empty((1 + 2 * len(centre), 2))
+  strip[0] = points[0]
+  strip[1::2] = centre + side
+  strip[2::2] = centre - side
+  geometry.STREAM.Add(GL_TRIANGLES, geometry.Strip(strip), color)
+  geometry.STREAM.Flush(GL_TRIANGLES)
+
+
+# Parsed meshes are cached next to the OBJ file in this binary format:
+# a header, then float32 vertices (x, y, z, u, v, nx, ny, nz) and uint32
+# triangle indices. Bump the version when the parsing changes.
+MESH_CACHE_MAGIC = 'NMSH'
+MESH_CACHE_VERSION = 2
+MESH_CACHE_HEADER = struct.Struct('<4sI20sII')
+
+
+def ParseObj(filename, scale, offset):
+  """Returns the vertex and index arrays for an OBJ file.
+
+  Only positions, texture coordinates and the first three corners of each
+  face are used. Normals are averaged from the faces around each vertex.
+  """
+  with open(filename) as f:
+    text = f.read()
+  v_lines = re.findall(r'^v +(.*)$', text, re.M)
+  vt_lines = re.findall(r'^vt +(.*)$', text, re.M)
+  f_lines = re.findall(r'^f +(.*)$', text, re.M)
+
+  vertices = ParseObjNumbers(v_lines, 3) * scale + offset
+  texture_vertices = ParseObjNumbers(vt_lines, 2)
+  # (face, corner, [v, vt]), zero-based.
+  faces = ParseObjFaces(f_lines) - 1
+  print '%i vertices, %i tvertices, %i faces' % (len(vertices), len(texture_vertices), len(faces))
+
+  print 'calculating normals'
+  vi = faces[:, :, 0]
+  v0, v1, v2 = vertices[vi[:, 0]], vertices[vi[:, 1]], vertices[vi[:, 2]]
+  face_normals = numpy.cross(v1 - v0, v2 - v0)
+  # Sum the normals of the faces around each vertex. bincount does the
+  # scatter-add much faster than numpy.add.at.
+  normals = numpy.column_stack([
+    numpy.bincount(vi.ravel(), weights=numpy.repeat(face_normals[:, axis], 3),
+                   minlength=len(vertices))
+    for axis in xrange(3)])
+  lengths = numpy.sqrt((normals * normals).sum(axis=1))
+  lengths[lengths == 0] = 1
+  normals /= lengths[:, None]
+
+  print 'filling buffers'
+  # Every distinct (v, vt) pair becomes one GL vertex, numbered in the order
+  # it first appears.
+  corners = faces.reshape(-1, 2)
+  keys = corners[:, 0] * max(len(texture_vertices), 1) + corners[:, 1]
+  _, first, inverse = numpy.unique(keys, return_index=True, return_inverse=True)
+  order = numpy.argsort(first)
+  rank = numpy.empty_like(order)
+  rank[order] = numpy.arange(len(order))
+  gl_indices = rank[inverse].astype(numpy.uint32)
+  used = corners[first[order]]
+  gl_vertices = numpy.hstack([
+    vertices[used[:, 0]],
+    texture_vertices[used[:, 1]],
+    normals[used[:, 0]]]).astype(numpy.float32)
+
+  print '%i glverts, %i glindices, %i num_v' % (gl_vertices.size, len(gl_indices), len(gl_vertices))
+  return gl_vertices, gl_indices
+
+
+def ParseObjNumbers(lines, count):
+  """Returns the first count numbers of each line as an (n, count) array."""
+  # Fast path: every line has exactly count numbers.
+  numbers = numpy.fromstring(' '.join(lines), sep=' ')
+  if len(numbers) == count * len(lines):
+    return numbers.reshape(-1, count)
+  return numpy.array([line.split()[:count] for line in lines], dtype=float)
+
+
+def ParseObjFaces(lines):
+  """Returns the (v, vt) indices of the first three corners of each face."""
+  # Fast path: every face is a triangle of v/vt pairs.
+  text = ' '.join(lines)
+  if text.count('/') == 3 * len(lines):
+    indices = numpy.fromstring(text.replace('/', ' '), dtype=int, sep=' ')
+    if len(indices) == 6 * len(lines):
+      return indices.reshape(-1, 3, 2)
+  return numpy.array([[vtp.split('/')[:2] for vtp in line.split()[:3]]
+                      for line in lines], dtype=int)
+
+
+def MeshCacheKey(filename, scale, offset):
+  """Hash of everything the parsed mesh depends on."""
+  h = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    h.update(f.read())
+  h.update(repr((MESH_CACHE_VERSION, list(scale), list(offset))))
+  return h.digest()
+
+
+def ReadMeshCache(filename, key):
+  """Returns (vertices, indices) from a cache file, or None if it is stale."""
+  try:
+    with open(filename, 'rb') as f:
+      header = f.read(MESH_CACHE_HEADER.size)
+      if len(header) != MESH_CACHE_HEADER.size:
+        return None
+      magic, version, cached_key, num_v, num_i = MESH_CACHE_HEADER.unpack(header)
+      if magic != MESH_CACHE_MAGIC or version != MESH_CACHE_VERSION or cached_key != key:
+        return None
+      vertices = numpy.fromfile(f, dtype=numpy.float32, count=num_v * 8)
+      indices = numpy.fromfile(f, dtype=numpy.uint32, count=num_i)
+  except IOError:
+    return None
+  if len(vertices) != num_v * 8 or len(indices) != num_i:
+    return None
+  return vertices.reshape(-1, 8), indices
+
+
+def WriteMeshCache(filename, key, vertices, indices):
+  # Written to a temporary file first, so a crash never leaves a broken cache.
+  # Failing to write (read-only install) just means parsing again next time.
+  tmp = filename + '.tmp'
+  try:
+    with open(tmp, 'wb') as f:
+      f.write(MESH_CACHE_HEADER.pack(
+        MESH_CACHE_MAGIC, MESH_CACHE_VERSION, key, len(vertices), len(indices)))
+      vertices.tofile(f)
+      indices.tofile(f)
+    if os.path.exists(filename):
+      os.remove(filename)
+    os.rename(tmp, filename)
+  except (IOError, OSError) as e:
+    print 'Could not write mesh cache %s (%s)' % (filename, e)
+
+
+def LoadObj(filename, scale, offset):
+  """Returns (vertices, indices) for an OBJ file, parsing it only if needed."""
+  cache = filename + '.mesh'
+  key = MeshCacheKey(filename, scale, offset)
+  data = ReadMeshCache(cache, key)
+  if data is None:
+    data = ParseObj(filename, scale, offset)
+    WriteMeshCache(cache, key, *data)
+  return data
+
+
+def DrawLoadingScreen(fraction):
+  glClear(GL_DEPTH_BUFFER_BIT | GL_COLOR_BUFFER_BIT)
+  glDisable(GL_BLEND)
+  w = 0.8 * RATIO
+  outline = numpy.array([(-w, -0.03), (w, -0.03), (w, 0.03), (-w, 0.03)])
+  right = -w + 2 * w * fraction
+  bar = numpy.array([[(-w, -0.02), (right, -0.02), (right, 0.02), (-w, 0.02)]])
+  # The outline is a loop of four lines.
+  geometry.STREAM.Add(GL_LINES, outline[[0, 1, 1, 2, 2, 3, 3, 0]], (1, 1, 1, 1))
+  geometry.STREAM.Add(GL_TRIANGLES, geometry.Quads(bar), (1, 1, 1, 1))
+  geometry.STREAM.Flush()
 
 
 class ObjMesh(object):
-  def __init__(self, filename, texture, scale, offset):
+  def __init__(self, filename, texture, scale, offset, data=None):
+    """data is the result of LoadObj, if it was already loaded elsewhere."""
     self.texture = texture
-
-    vertices = []
-    texture_vertices = []
-    faces = []
-    for line in file(filename):
-      if line[0] == '#':
-        continue
-      if line.startswith('v '):
-        vert = map(float, line.split()[1:4])
-        for i in xrange(3):
-          vert[i] = vert[i] * scale[i] + offset[i]
-        vertices.append(vert)
-        continue
-      if line.startswith('vt '):
-        vert = map(float, line.split()[1:3])
-        texture_vertices.append(vert)
-        continue
-      if line.startswith('f '):
-        vtps = [tuple(map(int, vtp.split('/'))) for vtp in line.split()[1:4]]
-        faces.append(vtps)
-        continue
-
-    print '%i vertices, %i tvertices, %i faces' % (len(vertices), len(texture_vertices), len(faces))
-
-    print 'calculating normals'
-    normals = [[0, 0, 0, 0]] * len(vertices)
-    for face in faces:
-      v0 = vertices[face[0][0] - 1]
-      v1 = vertices[face[1][0] - 1]
-      v2 = vertices[face[2][0] - 1]
-      dv = [x - y for x, y in zip(v1, v0)]
-      dw = [x - y for x, y in zip(v2, v0)]
-      n = [dv[1] * dw[2] - dv[2] * dw[1],
-           dv[2] * dw[0] - dv[0] * dw[2],
-           dv[0] * dw[1] - dv[1] * dw[0]]
-      for i in xrange(3):
-        normals[face[i][0] - 1] = [
-          x + y for x, y in zip(normals[face[i][0] - 1], n + [1])]
-
-    print 'normalizing normals'
-    norm_normals = []
-    for n in normals:
-      n[0] /= n[3]
-      n[1] /= n[3]
-      n[2] /= n[3]
-      d = math.sqrt(n[0] * n[0] + n[1] * n[1] + n[2] * n[2])
-      n[0] /= d
-      n[1] /= d
-      n[2] /= d
-      norm_normals.append(n[:3])
-
-    print 'filling buffers'
-    vtp_seen = {}
-    gl_vertices = []
-    num_v = 0
-    gl_indices = []
-    for face in faces:
-      for vtp in face:
-        if vtp not in vtp_seen:
-          v = vertices[vtp[0] - 1]
-          vt = texture_vertices[vtp[1] - 1]
-          gl_vertices += v
-          gl_vertices += vt
-          n = norm_normals[vtp[0] - 1]
-          gl_vertices += n
-          vtp_seen[vtp] = num_v
-          num_v += 1
-        gl_indices.append(vtp_seen[vtp])
-
-    print '%i glverts, %i glindices, %i num_v' % (len(gl_vertices), len(gl_indices), num_v)
+    self.num_vert = 0
+    self.r = 0
+    if HEADLESS:
+      return
+    vertices, indices = data or LoadObj(filename, scale, offset)
 
     self.vbo, self.ibo = glGenBuffers(2)
-    vbuf = (ctypes.c_float * (num_v * 8))()
-    for i, v in enumerate(gl_vertices):
-      vbuf[i] = v
-    ibuf = (ctypes.c_uint * len(gl_indices))()
-    for i, v in enumerate(gl_indices):
-      ibuf[i] = v
-
     glBindBuffer(GL_ARRAY_BUFFER, self.vbo)
-    glBufferData(GL_ARRAY_BUFFER, ctypes.sizeof(vbuf), vbuf,
+    glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices,
                  GL_STATIC_DRAW)
     glBindBuffer(GL_ARRAY_BUFFER, 0)
 
     glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.ibo)
-    glBufferData(GL_ELEMENT_ARRAY_BUFFER, ctypes.sizeof(ibuf), ibuf,
+    glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices,
                  GL_STATIC_DRAW)
     glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
 
-    self.num_vert = len(gl_indices)
-    self.r = 0
+    self.num_vert = len(indices)
 
   def Render(self, center, scale, forward):
     F = ctypes.sizeof(ctypes.c_float)
@@ -1,17 +1,23 @@
 # coding: utf8
 import math
+import numpy
 import random
 import pygame
 import sys
 from OpenGL.GL import *
 
+import ai
 import assets
 import background
 import crystals
 import dialog
+import entities
+import paths
+import projectiles
 import rendering
 import shapes
 import ships
+import spatial
 
 BIGSHIP_UP_KEY = pygame.K_w
 BIGSHIP_DOWN_KEY = pygame.K_s
@@ -19,6 +25,20 @@ BIGSHIP_LEFT_KEY = pygame.K_a
 BIGSHIP_RIGHT_KEY = pygame.K_d
 BIGSHIP_CONTROL_KEYS = [BIGSHIP_UP_KEY, BIGSHIP_DOWN_KEY, BIGSHIP_LEFT_KEY, BIGSHIP_RIGHT_KEY]
 
+# Cell size of the grid used for collision checks between ships.
+SHIP_GRID_CELL = 0.25
+
+# Length of a simulation step in seconds. Rendering interpolates between the
+# last two steps, so the frame rate does not affect gameplay.
+FIXED_DT = 1 / 60.
+MAX_FPS = 120
+# Frame times are clamped to this, so a long hitch is not followed by a burst
+# of catch-up steps.
+MAX_FRAME_TIME = 0.25
+# About how many milliseconds per step the computer controlled ships may
+# spend deciding what to do. Ships over the budget decide on the next step.
+AI_BUDGET_MS = 2.0
+
 
 def Music(filename):
   try:
@@ -29,13 +49,37 @@ def Music(filename):
     print "Music playback doesn't seem to work (%r). Sorry." % e
 
 
+class PygameInput(object):
+  """Reads player input from the pygame event queue."""
+
+  def Events(self):
+    return pygame.event.get()
+
+  def MousePosition(self):
+    return pygame.mouse.get_pos()
+
+  def PressedKeys(self):
+    return pygame.key.get_pressed()
+
+
 class Game(object):
 
-  def __init__(self):
+  def __init__(self, input_source=None, seed=None, fixed_dt=FIXED_DT):
+    """Pass fixed_dt=None to step the simulation once per frame instead."""
+    self.input = input_source or PygameInput()
+    self.random = random.Random(seed)
+    self.fixed_dt = fixed_dt
+    self.time = 0
+    # Ships created from now on keep their state in these.
+    self.entities = ships.Ship.store = entities.EntityStore()
     self.ships = []
     self.crystals = []
     self.shapes = []
-    self.projectiles = []
+    self.shape_batch = shapes.ShapeBatch()
+    self.projectiles = projectiles.ProjectilePool()
+    self.paths = paths.PathManager()
+    self.ai = ai.Scheduler(AI_BUDGET_MS)
+    self.ship_grid = spatial.SpatialHash(SHIP_GRID_CELL)
     self.drawing = []
     self.paths_followed = 0
     self.drawing_in_progress = False
@@ -46,6 +90,10 @@ class Game(object):
     self.Loop()
 
   def Init(self):
+    self.InitDisplay()
+    self.InitGame()
+
+  def InitDisplay(self):
     pygame.init()
     pygame.display.set_mode((int(rendering.WIDTH), int(rendering.HEIGHT)), pygame.OPENGL | pygame.DOUBLEBUF | pygame.HWSURFACE)
     pygame.display.set_caption('The Sea of Good and Bad')
@@ -68,11 +116,12 @@ class Game(object):
     glEnable(GL_DEPTH_TEST)
     glDepthFunc(GL_ALWAYS)
 
-    assets.Init()
+  def InitGame(self):
+    assets.Init(progress=self.ShowLoadingProgress)
     self.b = background.BackGround((-rendering.RATIO, rendering.RATIO), (-1, 1), (0.9, 0.3, 0.6))
 
     self.dialog = dialog.Dialog()
-    self.crystals = crystals.Crystals(max_crystals=20)
+    self.crystals = crystals.Crystals(max_crystals=20, rng=self.random)
 
     self.father_ship = ships.OurBigShip(-0.5, 0, 0.2)
     self.father_ship.AI = 'HumanFather'
@@ -108,6 +157,17 @@ class Game(object):
     # Track in-progress shapes.
     # Shape being drawn right now:
     self.shape_being_drawn = None
+    # Recognizes the shape along self.drawing as it is drawn.
+    self.recognizer = None
+    # Thins out self.drawing to its corners as it is drawn.
+    self.simplifier = None
+    # Whether the needle was sent ahead to the first corner of the stroke.
+    self.needle_heading = False
+
+  def ShowLoadingProgress(self, fraction):
+    rendering.DrawLoadingScreen(fraction)
+    pygame.display.flip()
+    pygame.event.pump()
 
   def AddEnemy(self, enemy, with_small_ship=False, final_battle=False):
     enemy.faction = 2
@@ -147,51 +207,66 @@ class Game(object):
 
   def Loop(self):
     clock = pygame.time.Clock()
-    self.time = 0
     next_fps_print = 0
+    accumulator = 0
     while True:
       if self.time > next_fps_print:
-        print clock
+        print clock, rendering.TEXTURES
         next_fps_print = self.time + 2
-      dt = 0.001 * clock.tick()
-      self.dialog.Update(dt, self)
-      if self.dialog.paused:
-        self.drawing_in_progress = False
-        self.drawing = []
+      frame_time = min(0.001 * clock.tick(MAX_FPS), MAX_FRAME_TIME)
+      assets.Meshes.Poll()
+      if self.fixed_dt:
+        accumulator += frame_time
+        while accumulator >= self.fixed_dt:
+          self.Step(self.fixed_dt)
+          accumulator -= self.fixed_dt
+        self.Render(accumulator / self.fixed_dt)
       else:
-        self.Update(dt)
-      glClear(GL_DEPTH_BUFFER_BIT | GL_COLOR_BUFFER_BIT)
-      self.b.Draw(self.time, False)
-      glColor(1, 1, 1, 1)
-      rendering.DrawPath(self.drawing)
-      if self.shape_being_drawn:
-        self.shape_being_drawn.Render()
-      if self.needle_ship.shape_being_traced:
-        self.needle_ship.shape_being_traced.Render()
-      for o in self.shapes:
-        o.Render()
-      self.crystals.Render()
-      for o in self.ships:
-        o.Render()
-      for o in self.projectiles:
-        o.Render()
-      self.b.Draw(self.time, True)
-      self.dialog.Render(self)
+        self.Step(frame_time)
+        self.Render()
       pygame.display.flip()
 
+  def Step(self, dt):
+    """Advances the dialog and the simulation by dt seconds."""
+    self.entities.SavePositions()
+    self.projectiles.SavePositions()
+    self.dialog.Update(dt, self)
+    if self.dialog.paused:
+      self.drawing_in_progress = False
+      self.drawing = []
+    else:
+      self.Update(dt)
+
+  def Render(self, alpha=1.0):
+    """Draws the game, alpha of the way from the previous step to the last."""
+    glClear(GL_DEPTH_BUFFER_BIT | GL_COLOR_BUFFER_BIT)
+    self.b.Draw(self.time, False)
+    glColor(1, 1, 1, 1)
+    rendering.DrawPath(self.drawing)
+    if self.shape_being_drawn:
+      self.shape_being_drawn.Render()
+    if self.needle_ship.shape_being_traced:
+      self.needle_ship.shape_being_traced.Render()
+    self.shape_batch.Render(self.shapes)
+    self.crystals.Render()
+    for o in self.ships:
+      o.Render(alpha)
+    self.projectiles.Render(alpha)
+    self.b.Draw(self.time, True)
+    self.dialog.Render(self)
+
   def GameSpace(self, x, y):
     return 2 * x / rendering.HEIGHT - rendering.RATIO, 1 - 2 * y / rendering.HEIGHT
 
   def Distance(self, ship1, ship2):
-    if hasattr(ship1, "size"):
-      s1 = ship1.size
-    else:
-      s1 = 0
-    if hasattr(ship2, "size"):
-      s2 = ship2.size
-    else:
-      s2 = 0 
-    return math.hypot(ship1.x - ship2.x, ship1.y - ship2.y) - (s1 + s2) / 3.0 # not sure about this value
+    return math.hypot(ship1.x - ship2.x, ship1.y - ship2.y) - (ship1.size + ship2.size) / 3.0 # not sure about this value
+
+  def UpdateShipGrid(self):
+    # Ships are entered with their full size as the radius. That covers the
+    # largest reach any of the collision checks allow for.
+    self.ship_grid.Clear()
+    for ship in self.ships:
+      self.ship_grid.Insert(ship, ship.x, ship.y, ship.size)
 
   def MoveObject(self, ship):
     if ship.path_func:
@@ -209,6 +284,31 @@ class Game(object):
       if isinstance(ship, ships.SmallShip) and ship.shape_being_traced:
         ship.shape_being_traced.ShipVisited(i)
 
+  def MoveObjects(self):
+    """Moves every ship along its path. ShipPaths are evaluated together."""
+    moving = []
+    for ship in self.ships:
+      if isinstance(ship.path_func, ships.ShipPath):
+        moving.append(ship)
+      else:
+        self.MoveObject(ship)
+    self.paths.Sync(moving)
+    if not moving:
+      return
+    x, y, dx, dy, index, finished = self.paths.Evaluate(self.time)
+    ids = [ship.entity_id for ship in moving]
+    self.entities.x[ids] = x
+    self.entities.y[ids] = y
+    self.entities.dx[ids] = numpy.where(finished, self.entities.dx[ids], dx)
+    self.entities.dy[ids] = numpy.where(finished, self.entities.dy[ids], dy)
+    for ship, i, done in zip(moving, index.tolist(), finished.tolist()):
+      if done:
+        ship.path_func = None
+        if ship is self.needle_ship:
+          self.paths_followed += 1
+      if isinstance(ship, ships.SmallShip) and ship.shape_being_traced:
+        ship.shape_being_traced.ShipVisited(None if i < 0 else i)
+
   def InRangeOfTarget(self, source, r, target):
     if not target:
       return False
@@ -222,6 +322,13 @@ class Game(object):
                                              obj.y - y))
     return nearest
 
+  def NearestEnemy(self, ship):
+    return self.entities.Nearest(ship.x, ship.y, self.entities.faction != ship.faction)
+
+  def RemoveShip(self, ship):
+    self.ships.remove(ship)
+    ship.Release()
+
   def HealBack(self):
     self.father_ship.health = 10
     self.needle_ship.health = 1
@@ -231,7 +338,7 @@ class Game(object):
     self.time += dt
     self.crystals.Update(dt, self)
 
-    for e in pygame.event.get():
+    for e in self.input.Events():
       if e.type == pygame.QUIT or e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE:
         pygame.quit()
         sys.exit(0)
@@ -253,8 +360,7 @@ class Game(object):
             if self.drawing_in_progress:
               if (e.type == pygame.MOUSEBUTTONUP and e.button == 1) or (e.type == pygame.KEYUP and e.key in [pygame.K_RSHIFT, pygame.K_LSHIFT]):
                 self.drawing_in_progress = False
-                shape_path = shapes.ShapeFromMouseInput(
-                  self.drawing, self.crystals)
+                shape_path = self.recognizer.Shape()
                 if smallship.shape_being_traced:
                   smallship.shape_being_traced.Cancel()
                 if self.shape_being_drawn is not None and self.shape_being_drawn.CompleteWithPath(shape_path):
@@ -275,19 +381,27 @@ class Game(object):
                 self.drawing = []
 
               if e.type == pygame.MOUSEMOTION:
-                self.drawing.append(self.GameSpace(*e.pos))
-                self.drawing = shapes.FilterMiddlePoints(self.drawing, 50)
-                # TODO(alex): Updating while in progress is nice, but too
-                # now. Need to incrementally build the path for this to work.
-                #shape_path = shapes.ShapeFromMouseInput(
-                #  self.drawing, self.crystals)
-                #self.shape_being_drawn.UpdateWithPath(shape_path)
+                point = self.GameSpace(*e.pos)
+                self.drawing = self.simplifier.Add(point)
+                self.recognizer.Sync(self.drawing)
+                shape_path = self.recognizer.Path()
+                self.shape_being_drawn.UpdateWithPath(shape_path)
+                if shape_path and not smallship.shape_being_traced and not self.needle_heading:
+                  # Head for the first corner while the rest is drawn.
+                  self.needle_heading = True
+                  smallship.path_func = ships.ShipPathFromWaypoints(
+                    (smallship.x, smallship.y), (smallship.dx, smallship.dy),
+                    [(shape_path[0].x, shape_path[0].y)], smallship.max_velocity)
+                  smallship.path_func_start_time = self.time
 
             if (e.type == pygame.MOUSEBUTTONDOWN and e.button == 1) or (e.type == pygame.KEYDOWN and e.key in [pygame.K_RSHIFT, pygame.K_LSHIFT]):
-              pos = pygame.mouse.get_pos()
-              self.drawing = [self.GameSpace(*pos)]
+              pos = self.input.MousePosition()
+              self.simplifier = shapes.PathSimplifier(50, [self.GameSpace(*pos)])
+              self.drawing = self.simplifier.points
               self.shape_being_drawn = shapes.Shape(self)
-              #shape_path = shapes.ShapeFromMouseInput(self.drawing, self.crystals)
+              self.recognizer = shapes.ShapeRecognizer(self.crystals)
+              self.recognizer.Sync(self.drawing)
+              self.needle_heading = False
               self.drawing_in_progress = True    
 
       for bigship in self.ships:
@@ -299,7 +413,7 @@ class Game(object):
             bigship.path_func_start_time = self.time
 
           if e.type in [pygame.KEYUP, pygame.KEYDOWN] and e.key in BIGSHIP_CONTROL_KEYS:
-            pressed_keys = pygame.key.get_pressed()
+            pressed_keys = self.input.PressedKeys()
             up = pressed_keys[BIGSHIP_UP_KEY]
             down = pressed_keys[BIGSHIP_DOWN_KEY]
             left = pressed_keys[BIGSHIP_LEFT_KEY]
@@ -343,62 +457,9 @@ class Game(object):
                 [(target_x, target_y)], bigship.max_velocity)
               bigship.path_func_start_time = self.time
 
-    # TODO: if owner is deleted, projectiles will crash the game
-    for projectile in list(self.projectiles):
-      self.MoveObject(projectile)
-      if self.Distance(projectile, projectile.owner) > projectile.owner.combat_range or projectile.path_func_start_time + projectile.lifetime < self.time:
-        self.projectiles.remove(projectile)
-        continue
-      for enemy in self.ships:
-        if enemy.faction != projectile.faction and self.Distance(enemy, projectile) < (enemy.size + projectile.size) / 2:
-          enemy.health -= random.gauss(projectile.damage, 0.1)
-          self.projectiles.remove(projectile)
-          break
+    self.ai.Update(self)
 
     for ship in self.ships:
-      if ship.AI == 'Wandering' and not ship.path_func:
-          ship.path_func = ships.ShipPathFromWaypoints(
-            (ship.x, ship.y), (ship.dx, ship.dy),
-            [(random.uniform(-0.9*rendering.RATIO, 0.9*rendering.RATIO), random.uniform(-0.9, 0.9))],
-            ship.max_velocity)
-          ship.path_func_start_time = self.time
-      elif ship.AI == 'Kraken':
-        if self.time > ship.target_reevaluation:
-          ship.target_reevaluation = self.time + 2.0
-          enemies = [enemy for enemy in self.ships if ship.faction != enemy.faction]
-          nearest = self.NearestObjectFromList(ship.x, ship.y, enemies)
-          ship.target = nearest
-          ship.path_func = ships.ShipPathFromWaypoints(
-            (ship.x, ship.y), (ship.dx, ship.dy),
-            [(nearest.x, nearest.y)], ship.max_velocity)
-          ship.path_func_start_time = self.time
-      elif ship.AI == 'Evil Needle':
-        if ship.shape_being_traced is None and self.time > ship.target_reevaluation:
-          ship.target_reevaluation = self.time + random.gauss(12.0, 2.0)
-          available_crystals = [c for c in self.crystals if not c.in_shape and c.visible]
-          if len(available_crystals) >= 3:
-            number_of_tries = 30
-            shape_paths = []
-            for i in range(number_of_tries):
-              n = None
-              while not n or len(available_crystals) < n:
-                n = random.randint(3, 5)
-              shape_path = random.sample(available_crystals, n)
-              shape_score = shapes.ShapeScore([(c.x, c.y) for c in shape_path])
-              for path in shape_path:
-                nearest = self.NearestObjectFromList(path.x, path.y, self.ships)
-                if ship.faction != nearest.faction:
-                  shape_score *= 0.4 # if enemy is near factor score lower
-              shape_path += [shape_path[0]]
-              shape_paths.append((shape_score, shape_path))
-            shape_path = max(shape_paths)[1]
-            ship.path_func = ships.ShipPathFromWaypoints(
-              (ship.x, ship.y), (0, 0),
-              [(c.x, c.y) for c in shape_path], ship.max_velocity)
-            ship.path_func_start_time = self.time
-            ship.shape_being_traced = shapes.Shape(self)
-            ship.shape_being_traced.CompleteWithPath(shape_path)
-
       if ship.health <= 0:
         if ship is self.father_ship:
           self.dialog.FatherDestroyed()
@@ -407,9 +468,13 @@ class Game(object):
             if isinstance(smallship, ships.SmallShip) and smallship.owner is ship:
               if smallship.shape_being_traced:
                 smallship.shape_being_traced.Cancel()
-              self.ships.remove(smallship)
-          self.ships.remove(ship)
-      self.MoveObject(ship)
+              self.RemoveShip(smallship)
+          self.RemoveShip(ship)
+
+    self.MoveObjects()
+    self.UpdateShipGrid()
+
+    self.projectiles.Update(self)
 
     mana_of_friends = sum([
       ship.mana for ship in self.ships if isinstance(ship, ships.BigShip) and ship.faction == self.father_ship.faction
@@ -421,18 +486,10 @@ class Game(object):
     # shoot at nearest enemy in range
     for bigship in self.ships:
       if isinstance(bigship, ships.BigShip):
-        if random.gauss(bigship.cooldown, 0.1) - bigship.prev_fire <= 0 and bigship.mana >= bigship.ammo_cost:
-          enemies = [ship for ship in self.ships if bigship.faction != ship.faction]
-          nearest_enemy = self.NearestObjectFromList(bigship.x, bigship.y, enemies)
-          if self.InRangeOfTarget(bigship, bigship.combat_range, nearest_enemy):
-            projectile = ships.Projectile(bigship.x, bigship.y, 0.075)
-            projectile.owner = bigship
-            projectile.faction = bigship.faction
-            projectile.path_func = ships.ShipPathFromWaypoints(
-              (projectile.x, projectile.y), (projectile.dx, projectile.dy),
-              [(nearest_enemy.x, nearest_enemy.y)], projectile.max_velocity)
-            projectile.path_func_start_time = self.time
-            self.projectiles.append(projectile)
+        if self.random.gauss(bigship.cooldown, 0.1) - bigship.prev_fire <= 0 and bigship.mana >= bigship.ammo_cost:
+          nearest_enemy = self.NearestEnemy(bigship)
+          if (self.InRangeOfTarget(bigship, bigship.combat_range, nearest_enemy) and
+              self.projectiles.Spawn(bigship, nearest_enemy.x, nearest_enemy.y, self.time)):
             bigship.prev_fire = 0.0
             bigship.mana = max(bigship.mana - bigship.ammo_cost, 0)
             print '%s\'s mana is now %0.2f' % (bigship.name, bigship.mana)
@@ -457,7 +514,8 @@ class Game(object):
             print '%s\'s health is now %0.2f' % (bigship.name, bigship.health)
             bigship.target = None
             bigship.target_reevaluation = self.time + 0.5
-        for smallship in self.ships:
+            self.ai.Reschedule(bigship)
+        for smallship in self.ship_grid.Query(bigship.x, bigship.y, bigship.size / 3.0 + 0.01):
           if isinstance(smallship, ships.SmallShip):
             if bigship.faction == smallship.faction and self.Distance(bigship, smallship) < 0.01:
               if bigship.mana > 0 and smallship.health < smallship.max_health:
@@ -467,39 +525,6 @@ class Game(object):
                 print '%s\'s mana is now %0.2f' % (bigship.name, bigship.mana)
                 print '%s\'s health is now %0.2f' % (smallship.name, smallship.health)
 
-        if bigship.AI == "Chasing shapes":
-          if self.time > bigship.target_reevaluation:
-            bigship.target_reevaluation = self.time + 0.5
-            nearest = self.NearestObjectFromList(bigship.x, bigship.y, self.shapes)
-            if nearest and nearest != bigship.target:
-              bigship.target = nearest
-              bigship.path_func = ships.ShipPathFromWaypoints(
-                (bigship.x, bigship.y), (bigship.dx, bigship.dy),
-                [(nearest.x, nearest.y)], bigship.max_velocity)
-              bigship.path_func_start_time = self.time
-
-        if bigship.AI == "Moron":
-          if self.time > bigship.target_reevaluation:
-            bigship.target_reevaluation = self.time + bigship.AI_smart
-            if (bigship.mana >= 400 or bigship.mana >= 200 and not self.NearestObjectFromList(bigship.x, bigship.y, self.shapes)) and bigship.health > 1.5:
-              enemies = [ship for ship in self.ships if bigship.faction != ship.faction]
-              nearest = self.NearestObjectFromList(bigship.x, bigship.y, enemies)
-            elif not self.NearestObjectFromList(bigship.x, bigship.y, self.shapes):
-              bigship.path_func = ships.ShipPathFromWaypoints(
-                (bigship.x, bigship.y), (bigship.dx, bigship.dy),
-                [(random.uniform(-0.9*rendering.RATIO, 0.9*rendering.RATIO), random.uniform(-0.9, 0.9))],
-                bigship.max_velocity)
-              bigship.path_func_start_time = self.time
-              nearest = None
-            else:
-              nearest = self.NearestObjectFromList(bigship.x, bigship.y, self.shapes)
-            if nearest:
-              bigship.target = nearest
-              bigship.path_func = ships.ShipPathFromWaypoints(
-                (bigship.x, bigship.y), (bigship.dx, bigship.dy),
-                [(nearest.x, nearest.y)], bigship.max_velocity)
-              bigship.path_func_start_time = self.time
-
     for smallship in self.ships:
       if isinstance(smallship, ships.SmallShip):
         if smallship.shape_being_traced:
@@ -509,7 +534,7 @@ class Game(object):
 
     for ship in self.ships:
       if ship.damage > 0:
-        for enemy in self.ships:
+        for enemy in self.ship_grid.Query(ship.x, ship.y, ship.size / 3.0):
           if ship.faction != enemy.faction and self.Distance(enemy, ship) < 0:
             enemy.health -= ship.damage
             print '%s\'s health is now %0.2f/%0.2f' % (enemy.name, enemy.max_health, enemy.health)
@@ -3,6 +3,8 @@ import math
 import numpy
 from OpenGL.GL import *
 
+import geometry
+
 
 # Factors for the amount of scoring penalty for a shape with unequal
 # side lengths or angles.
@@ -14,17 +16,54 @@ MISSED_ANGLE_PENALTY = 1.0
 DISTANCE_THRESHOLD = 0.1
 
 def FilterMiddlePoints(mouse_path, angle_threshold):
+  """Drops points where the path turns by less than angle_threshold degrees.
+
+  For a whole path at once. PathSimplifier does the same as points arrive.
+  """
   threshold = math.cos(math.radians(angle_threshold))
   if len(mouse_path) < 5:
       return mouse_path
-  vectors = [
-    (numpy.array([c2[0] - c1[0], c2[1] - c1[1]]), numpy.array([c3[0] - c2[0], c3[1] - c2[1]]))
-    for c1, c2, c3 in zip(mouse_path[:-2], mouse_path[1:-1], mouse_path[2:])
-  ]
-  unit_vectors = [(v1 / numpy.linalg.norm(v1), v2 / numpy.linalg.norm(v2)) for v1, v2 in vectors]
-  dots = [v1.dot(v2) for v1, v2 in unit_vectors]
-  good_points = [mouse_path[i+1] for i in range(len(dots)) if dots[i] < threshold]
-  return [mouse_path[0]] + good_points + [mouse_path[-1]]
+  points = numpy.array(mouse_path, dtype=float)
+  v1 = points[1:-1] - points[:-2]
+  v2 = points[2:] - points[1:-1]
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    u1 = v1 / numpy.sqrt((v1 * v1).sum(axis=1))[:, None]
+    u2 = v2 / numpy.sqrt((v2 * v2).sum(axis=1))[:, None]
+    # Repeated points give NaN, which never passes the threshold.
+    dots = (u1 * u2).sum(axis=1)
+    good = numpy.nonzero(dots < threshold)[0]
+  return [mouse_path[0]] + [mouse_path[i + 1] for i in good] + [mouse_path[-1]]
+
+
+class PathSimplifier(object):
+  """FilterMiddlePoints for a mouse path that grows one point at a time.
+
+  Each new point drops the points before it that no longer look like
+  corners, the way running FilterMiddlePoints again after every point
+  would. Every point is dropped at most once, so the work per point does
+  not grow with the length of the path.
+  """
+
+  def __init__(self, angle_threshold, points=()):
+    self.threshold = math.cos(math.radians(angle_threshold))
+    self.points = []
+    for point in points:
+      self.Add(point)
+
+  def Add(self, point):
+    """Adds a point and returns the simplified path so far."""
+    points = self.points
+    while len(points) >= 2:
+      (x0, y0), (x1, y1) = points[-2], points[-1]
+      dx1, dy1 = x1 - x0, y1 - y0
+      dx2, dy2 = point[0] - x1, point[1] - y1
+      l = math.hypot(dx1, dy1) * math.hypot(dx2, dy2)
+      if l != 0 and (dx1 * dx2 + dy1 * dy2) / l < self.threshold:
+        break
+      points.pop()
+    points.append(point)
+    return points
+
 
 def ShapeFromMouseInput(mouse_path, crystals):
   """
@@ -42,50 +81,102 @@ def ShapeFromMouseInput(mouse_path, crystals):
   can occur only once in the list, except the first, which may be (and
   will be if the shape is closed) equal to the last.
 
-  (This should handle being called with an incomplete path, in which case
-  the trailing part of the mouse input might not be included in the shape.
-  These shapes won't be valid for scoring, but we might want to draw them
-  incrementally and start moving the ship in the general direction before we
-  know if the shape is complete and valid.)
+  Use ShapeRecognizer instead while the path is still being drawn.
   """
+  recognizer = ShapeRecognizer(crystals)
+  for mouse_coordinate in mouse_path:
+    recognizer.AddPoint(mouse_coordinate)
+  return recognizer.Shape()
 
-  # dictionaries for { type : [ .. indexes ..] }
-  touched_crystals = collections.defaultdict(list)
-  num_touched_crystals = collections.defaultdict(int)
 
-  used_crystals = set()
-  last_crystal = None
+class ShapeRecognizer(object):
+  """ShapeFromMouseInput for a mouse path that changes one point at a time.
 
-  for mouse_coordinate in mouse_path:
-    mouse_coordinate_x = mouse_coordinate[0]
-    mouse_coordinate_y = mouse_coordinate[1]
-    for crystal_index, crystal in enumerate(crystals):
+  Each AddPoint only looks at the new point. The crystals touched so far
+  are kept, so the current shape is available at any time while drawing.
+  PopPoint takes back the last point, so Sync can follow a path that only
+  changes at its end, like the one PathSimplifier keeps.
+  """
+
+  def __init__(self, crystals):
+    """crystals is a list, or a crystals.Crystals to use its index."""
+    self.crystals = crystals
+    self.query = getattr(crystals, 'Query', None)
+    # type -> crystals of that type, in the order they were first touched.
+    self.touched = collections.defaultdict(list)
+    self.used = set()
+    self.last_crystal = None
+    self.max_type = None
+    # (point, last_crystal and max_type before it, crystals it touched
+    # first) for each point added.
+    self.history = []
+
+  def AddPoint(self, mouse_coordinate):
+    self.history.append((mouse_coordinate, self.last_crystal, self.max_type, []))
+    mouse_coordinate_x, mouse_coordinate_y = mouse_coordinate
+    if self.query:
+      candidates = self.query(mouse_coordinate_x, mouse_coordinate_y, DISTANCE_THRESHOLD)
+    else:
+      candidates = self.crystals
+    for crystal in candidates:
       if not crystal.in_shape:
-        left_margin = crystal.x - DISTANCE_THRESHOLD
-        right_margin = crystal.x + DISTANCE_THRESHOLD
-        if left_margin < mouse_coordinate_x < right_margin:
-          bottom_margin = crystal.y - DISTANCE_THRESHOLD
-          top_margin = crystal.y + DISTANCE_THRESHOLD
-          if bottom_margin < mouse_coordinate_y < top_margin:
-            last_crystal = crystal
-            if crystal not in used_crystals:
-              num_touched_crystals[crystal.type] += 1
-              touched_crystals[crystal.type].append(crystal_index)
-              used_crystals.add(crystal)
-
-  if len(num_touched_crystals) == 0:
-    return None
-  max_type = max(num_touched_crystals, key=lambda x: num_touched_crystals[x])
-  if len(touched_crystals[max_type]) < 3:
-    return None
-
-  # If the path is closed (and not degenerate), we add the last
-  # crystal (equal to the first); it would not be added in the loop
-  # since it'd already be in used_crystals.
-  path = [crystals[i] for i in touched_crystals[max_type]]
-  if last_crystal and last_crystal == path[0] and len(path) > 1:
-    path.append(last_crystal)
-  return path
+        if abs(crystal.x - mouse_coordinate_x) < DISTANCE_THRESHOLD:
+          if abs(crystal.y - mouse_coordinate_y) < DISTANCE_THRESHOLD:
+            self.Touch(crystal)
+
+  def Touch(self, crystal):
+    self.last_crystal = crystal
+    if crystal not in self.used:
+      self.used.add(crystal)
+      if self.history:
+        self.history[-1][3].append(crystal)
+      touched = self.touched[crystal.type]
+      touched.append(crystal)
+      if self.max_type is None or len(touched) > len(self.touched[self.max_type]):
+        self.max_type = crystal.type
+
+  def PopPoint(self):
+    """Undoes the last AddPoint."""
+    point, self.last_crystal, self.max_type, added = self.history.pop()
+    for crystal in reversed(added):
+      self.used.discard(crystal)
+      self.touched[crystal.type].pop()
+
+  def Sync(self, points):
+    """Makes the points added so far the given ones.
+
+    Points are compared by identity, and only the end of the path may have
+    changed since the last call.
+    """
+    keep = min(len(points), len(self.history))
+    while keep and self.history[keep - 1][0] is not points[keep - 1]:
+      keep -= 1
+    while len(self.history) > keep:
+      self.PopPoint()
+    for point in points[keep:]:
+      self.AddPoint(point)
+
+  def Path(self):
+    """The crystals of the current partial shape, however few.
+
+    Ends with the first crystal again if the path was closed.
+    """
+    if self.max_type is None:
+      return []
+    path = [c for c in self.touched[self.max_type] if not c.in_shape]
+    # If the path is closed (and not degenerate), we add the last
+    # crystal (equal to the first); it would not be added in AddPoint
+    # since it'd already be in used.
+    if len(path) > 1 and self.last_crystal is path[0]:
+      path.append(self.last_crystal)
+    return path
+
+  def Shape(self):
+    """The current shape as ShapeFromMouseInput returns it."""
+    path = self.Path()
+    if len(set(path)) < 3:
+      return None
+    return path
 
 def ShapeScore(shape):
   """
@@ -102,54 +193,71 @@ def ShapeScore(shape):
   sides = len(shape)
   if sides < 3:
     return 0
-  vectors = []
-  lengths = []
-  for i in xrange(sides):
-    p0 = shape[i]
-    p1 = shape[(i + 1) % sides]
-    dx, dy = p1[0] - p0[0], p1[1] - p0[1]
-    l = math.hypot(dx, dy)
-    lengths.append(l)
-    if l <= 0:
-      l = 1
-    vectors.append((dx / l, dy / l))
-
-  angles = []
-  for i in xrange(sides):
-    v0 = vectors[i]
-    v1 = vectors[(i + 1) % sides]
-    dot = v0[0] * v1[0] + v0[1] * v1[1]
-    side = math.copysign(1, v0[0] * v1[1] - v0[1] * v1[0])
-    angle = math.acos(dot) * side
-    angles.append(angle)
-
-  angle_sum = abs(sum(angles) / math.pi)
-  
-  if sides >= 5:
-    self_intersecting = angle_sum < 1.9 or angle_sum > 2.1
-  else:
-    self_intersecting = False
-    
-  avg_length = sum(lengths) / sides
-  avg_angle = sum(angles) / sides
-  angle_diffs = 0
-  score = sides
-  for l, a in zip(lengths, angles):
-    l = 1 - abs(l / avg_length - 1) * MISSED_LENGTH_PENALTY
-    angle_diffs += abs(a - avg_angle)
-    score *= l
-  score /= (1 + angle_diffs / math.pi * MISSED_ANGLE_PENALTY)
+  return float(ShapeScores(numpy.array([shape], dtype=float), [sides])[0])
+
+def ShapeScores(shapes, sides):
+  """ShapeScore for many shapes at once.
 
-  if self_intersecting:
-    score *= 2
+  Args:
+    shapes: (N, max_sides, 2) array of shape paths. Rows with fewer sides
+    are padded at the end; the padding is ignored.
+    sides: The number of sides of each shape.
+
+  Returns:
+    An array of N scores, the same as ShapeScore gives for each shape.
+  """
+  shapes = numpy.asarray(shapes, dtype=float)
+  sides = numpy.asarray(sides, dtype=int)
+  n, max_sides = shapes.shape[:2]
+  rows = numpy.arange(n)[:, None]
+  k = numpy.arange(max_sides)
+  valid = k < sides[:, None]
+  following = (k + 1) % numpy.maximum(sides, 1)[:, None]
+
+  d = shapes[rows, following] - shapes
+  lengths = numpy.hypot(d[:, :, 0], d[:, :, 1])
+  safe = numpy.where(lengths <= 0, 1, lengths)
+  vectors = d / safe[:, :, None]
+  v0, v1 = vectors, vectors[rows, following]
+  dot = v0[:, :, 0] * v1[:, :, 0] + v0[:, :, 1] * v1[:, :, 1]
+  side = numpy.copysign(1, v0[:, :, 0] * v1[:, :, 1] - v0[:, :, 1] * v1[:, :, 0])
+  with numpy.errstate(invalid='ignore'):
+    angles = numpy.arccos(dot) * side
+  lengths = numpy.where(valid, lengths, 0)
+  angles = numpy.where(valid, angles, 0)
+
+  # Summed a column at a time, in the same order as ShapeScore's loops.
+  length_sum = numpy.zeros(n)
+  angle_sum = numpy.zeros(n)
+  for i in xrange(max_sides):
+    length_sum += lengths[:, i]
+    angle_sum += angles[:, i]
+  count = numpy.maximum(sides, 1)
+  # Shapes with less than 3 sides can give NaN angles; they score 0 anyway.
+  with numpy.errstate(invalid='ignore'):
+    self_intersecting = (sides >= 5) & (
+      (abs(angle_sum / math.pi) < 1.9) | (abs(angle_sum / math.pi) > 2.1))
+
+  avg_length = numpy.where(length_sum > 0, length_sum, 1) / count
+  avg_angle = angle_sum / count
+  angle_diffs = numpy.zeros(n)
+  score = sides.astype(float)
+  for i in xrange(max_sides):
+    l = 1 - abs(lengths[:, i] / avg_length - 1) * MISSED_LENGTH_PENALTY
+    score = numpy.where(valid[:, i], score * l, score)
+    angle_diffs += numpy.where(valid[:, i], abs(angles[:, i] - avg_angle), 0)
+  score /= (1 + angle_diffs / math.pi * MISSED_ANGLE_PENALTY)
 
-  return score
+  score = numpy.where(self_intersecting, score * 2, score)
+  return numpy.where(sides < 3, 0, score)
 
 
 class Shape(object):
   BEING_DRAWN = 0
   SHIP_TRACING_PATH = 1
   DONE = 2
+  # Shapes are points as far as Game.Distance is concerned.
+  size = 0
 
   def __init__(self, game):
     self.state = self.BEING_DRAWN
@@ -157,6 +265,7 @@ class Shape(object):
     self.ship_visited_to = 0
     self.game = game
     self.score = None
+    self.geometry_key = None
 
   def UpdateWithPath(self, path):
     if path is None:
@@ -203,103 +312,100 @@ class Shape(object):
       return True
     return False
 
-  def Render(self):
-    if self.state == self.BEING_DRAWN:
-      return
+  def Geometry(self):
+    """Returns packed (edges, glow) triangles, rebuilt only when they change.
 
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE)
-    for i in xrange(len(self.path)):
-      v0 = [self.path[i].x, self.path[i].y]
-      v1 = [self.path[(i + 1) % len(self.path)].x,
-            self.path[(i + 1) % len(self.path)].y]
-      dx = v1[0] - v0[0]
-      dy = v1[1] - v0[1]
-      l = math.hypot(dx, dy)
-      dx = dx / l * 0.01
-      dy = dy / l * 0.01
-      if i < self.ship_visited_to - 1:
-        glColor(1.0, 1.0, 0.2, 1.0)
-      else:
-        glColor(0.2, 0.2, 0.2, 0.6)
-      glBegin(GL_QUADS)
-      glVertex(v0[0] + dy, v0[1] - dx)
-      glVertex(v0[0] - dy, v0[1] + dx)
-      glVertex(v1[0] - dy, v1[1] + dx)
-      glVertex(v1[0] + dy, v1[1] - dx)
-      glEnd()
-
-      if i >= self.ship_visited_to - 1:
-        continue
-
-      dx *= 4
-      dy *= 4
-      glEnable(GL_BLEND)
-      glBegin(GL_TRIANGLES)
-
-      glColor(1.0, 1.0, 0.2, 0.5)
-      glVertex(v0[0]     , v0[1]     )
-      glColor(1.0, 1.0, 0.2, 0.0)
-      glVertex(v0[0] + dy, v0[1] - dx)
-      glVertex(v0[0] - dy, v0[1] + dx)
-
-      glColor(1.0, 1.0, 0.2, 0.5)
-      glVertex(v0[0]     , v0[1]     )
-      glColor(1.0, 1.0, 0.2, 0.0)
-      glVertex(v0[0] + dy, v0[1] - dx)
-      glVertex(v1[0] + dy, v1[1] - dx)
-
-      glColor(1.0, 1.0, 0.2, 0.5)
-      glVertex(v0[0]     , v0[1]     )
-      glColor(1.0, 1.0, 0.2, 0.0)
-      glVertex(v0[0] - dy, v0[1] + dx)
-      glVertex(v1[0] - dy, v1[1] + dx)
-
-      glColor(1.0, 1.0, 0.2, 0.5)
-      glVertex(v0[0]     , v0[1]     )
-      glVertex(v1[0]     , v1[1]     )
-      glColor(1.0, 1.0, 0.2, 0.0)
-      glVertex(v1[0] - dy, v1[1] + dx)
-
-      glColor(1.0, 1.0, 0.2, 0.5)
-      glVertex(v0[0]     , v0[1]     )
-      glVertex(v1[0]     , v1[1]     )
-      glColor(1.0, 1.0, 0.2, 0.0)
-      glVertex(v1[0] + dy, v1[1] - dx)
-
-      glColor(1.0, 1.0, 0.2, 0.5)
-      glVertex(v1[0]     , v1[1]     )
-      glColor(1.0, 1.0, 0.2, 0.0)
-      glVertex(v1[0] + dy, v1[1] - dx)
-      glVertex(v1[0] - dy, v1[1] + dx)
-
-      glEnd()
-      glDisable(GL_BLEND)
+    Edges are drawn without blending, glow with additive blending.
+    """
+    # Edges past the end of the path look the same however far the ship got.
+    key = (self.state, tuple(self.path),
+           min(self.ship_visited_to, len(self.path) + 1))
+    if key != self.geometry_key:
+      self.geometry_key = key
+      self.geometry = self.BuildGeometry()
+    return self.geometry
+
+  def BuildGeometry(self):
+    v0 = numpy.array([(c.x, c.y) for c in self.path])
+    if self.state == self.BEING_DRAWN:
+      # Not closed yet, so no edge back to the start.
+      v0, v1 = v0[:-1], v0[1:]
+    else:
+      v1 = numpy.roll(v0, -1, axis=0)
+    d = v1 - v0
+    l = numpy.hypot(d[:, 0], d[:, 1])
+    # Perpendicular to each edge, 0.01 long.
+    n = numpy.column_stack([d[:, 1], -d[:, 0]]) / l[:, None] * 0.01
+    visited = numpy.arange(len(v0)) < self.ship_visited_to - 1
+
+    edges = numpy.stack([v0 + n, v0 - n, v1 - n, v1 + n], axis=1)
+    colors = numpy.where(visited[:, None], (1.0, 1.0, 0.2, 1.0), (0.2, 0.2, 0.2, 0.6))
+    edges = geometry.Pack(geometry.Quads(edges), numpy.repeat(colors, 6, axis=0))
+
+    # Glow around the edges the ship has already traced.
+    a, b, g = v0[visited], v1[visited], 4 * n[visited]
+    glow = numpy.stack([
+      a, a + g, a - g,
+      a, a + g, b + g,
+      a, a - g, b - g,
+      a, b, b - g,
+      a, b, b + g,
+      b, b + g, b - g], axis=1).reshape(-1, 2)
+    bright, dark = (1.0, 1.0, 0.2, 0.5), (1.0, 1.0, 0.2, 0.0)
+    glow_colors = [bright, dark, dark] * 3 + [bright, bright, dark] * 2 + [bright, dark, dark]
+    glow = [geometry.Pack(glow, numpy.tile(glow_colors, (len(a), 1)))]
 
     if self.state == self.DONE:
       verts = [(c.x, c.y) for c in self.path]
-      verts = sorted(verts,
-                     key=lambda (x, y): math.atan2(y - self.y, x - self.x))
+      verts = numpy.array(sorted(verts,
+                          key=lambda (x, y): math.atan2(y - self.y, x - self.x)))
+      nxt = numpy.roll(verts, -1, axis=0)
+      centre = numpy.tile((self.x, self.y), (len(verts), 1))
+      middle = (verts + nxt + centre) / 3.
+      fan = numpy.stack([centre, verts, middle, centre, middle, nxt], axis=1).reshape(-1, 2)
       goodness = min(1, self.score / 5.)
-      glEnable(GL_BLEND)
-      glBegin(GL_TRIANGLES)
-      glColor(0, 1, 0, 1)
-      for i in xrange(len(verts)):
-        v0 = verts[i]
-        v1 = verts[(i + 1) % len(verts)]
-
-        glColor(1.0 - goodness, 1.0 - goodness, 0.2, goodness * 1.0 + 0.2)
-        glVertex(self.x, self.y)
-        glColor(1.0 - goodness, 1.0 - goodness, 0.2, 0.0)
-        glVertex(v0[0], v0[1])
-        glVertex((v0[0] + v1[0] + self.x) / 3.,
-                 (v0[1] + v1[1] + self.y) / 3.)
-
-        glColor(1.0 - goodness, 1.0 - goodness, 0.2, goodness * 1.0 + 0.2)
-        glVertex(self.x, self.y)
-        glColor(1.0 - goodness, 1.0 - goodness, 0.2, 0.0)
-        glVertex((v0[0] + v1[0] + self.x) / 3.,
-                 (v0[1] + v1[1] + self.y) / 3.)
-        glVertex(v1[0], v1[1])
-
-      glEnd()
-      glDisable(GL_BLEND)
+      inner = (1.0 - goodness, 1.0 - goodness, 0.2, goodness * 1.0 + 0.2)
+      outer = (1.0 - goodness, 1.0 - goodness, 0.2, 0.0)
+      glow.append(geometry.Pack(fan,
+        numpy.tile([inner, outer, outer, inner, outer, outer], (len(verts), 1))))
+
+    return edges, numpy.concatenate(glow)
+
+  def Render(self):
+    if len(self.path) < 2:
+      return
+    edges, glow = self.Geometry()
+    glBlendFunc(GL_SRC_ALPHA, GL_ONE)
+    geometry.STREAM.AddPacked(GL_TRIANGLES, edges)
+    geometry.STREAM.Flush(GL_TRIANGLES)
+    glEnable(GL_BLEND)
+    geometry.STREAM.AddPacked(GL_TRIANGLES, glow)
+    geometry.STREAM.Flush(GL_TRIANGLES)
+    glDisable(GL_BLEND)
+
+
+class ShapeBatch(object):
+  """Draws a list of completed shapes from two static buffers.
+
+  The buffers are refilled only when shapes are added or removed, so a
+  field of finished shapes costs two draw calls a frame.
+  """
+
+  def __init__(self):
+    self.shapes = ()
+    self.edges = geometry.Batch()
+    self.glow = geometry.Batch()
+
+  def Render(self, shapes):
+    shapes = tuple(shapes)
+    if shapes != self.shapes:
+      self.shapes = shapes
+      parts = [shape.Geometry() for shape in shapes]
+      empty = numpy.zeros((0, geometry.STRIDE), dtype=numpy.float32)
+      self.edges.Set(numpy.concatenate([empty] + [edges for edges, glow in parts]))
+      self.glow.Set(numpy.concatenate([empty] + [glow for edges, glow in parts]))
+    glBlendFunc(GL_SRC_ALPHA, GL_ONE)
+    self.edges.Draw(GL_TRIANGLES)
+    glEnable(GL_BLEND)
+    self.glow.Draw(GL_TRIANGLES)
+    glDisable(GL_BLEND)
@@ -1,8 +1,10 @@
+import bisect
 import pygame
 import math
 from OpenGL.GL import *
 
 import assets
+import entities
 import rendering
 import numpy
 
@@ -27,40 +29,66 @@ def ShipPathFromWaypoints(starting_location, starting_velocity, waypoints, max_v
   starting_velocity. For any time >= the time it takes to reach the final
   waypoint, it should return (final_waypoint, 0, 0).)
   """
-  waypoints_with_starting_location = [starting_location] + waypoints
-  waypoint_pairs = [(waypoints_with_starting_location[i], waypoints[i]) for i in range(len(waypoints))]
-  distances = [math.hypot(end[0] - start[0], end[1] - start[1])
-               for (start, end) in waypoint_pairs]
-  total_distance = sum(distances)
-  total_time = total_distance / max_velocity
+  return ShipPath(starting_location, starting_velocity, waypoints, max_velocity)
+
+
+class ShipPath(object):
+  """The path ShipPathFromWaypoints returns, as a plain object.
+
+  Cumulative distances along the waypoints are computed once, so finding
+  the segment for a time is a binary search. Holds only numbers and tuples,
+  so it can be pickled and printed.
+  """
   seconds_to_turn = 0.5
-  if total_distance == 0:
-    return lambda time: (starting_location[0], starting_location[1], 0, 0, None)
-
-  def curve(progress):
-    distance = progress * total_distance
-    accumulator = 0
-    for i in range(len(distances)):
-      if distance < accumulator + distances[i]:
-        start, end = waypoint_pairs[i]
-        small_progress = (distance - accumulator) / distances[i]
-        return (
-          start[0] + (end[0] - start[0]) * small_progress,
-          start[1] + (end[1] - start[1]) * small_progress,
-          (end[0] - start[0]) / distances[i],
-          (end[1] - start[1]) / distances[i],
-          i)
-      accumulator += distances[i]
-    return waypoints[-1] + (0, 0, i + 1)
-
-  if starting_velocity[0] == 0 and starting_velocity[1] == 0:
-    starting_velocity = (1, 0)
-  original_direction = numpy.array(starting_velocity)
-  original_direction /= numpy.linalg.norm(original_direction)
-
-  def control(time):
-    distance = 0
-    velocity = 0
+
+  def __init__(self, starting_location, starting_velocity, waypoints, max_velocity):
+    self.start = tuple(starting_location)
+    self.waypoints = [tuple(w) for w in waypoints]
+    self.max_velocity = max_velocity
+    points = [self.start] + self.waypoints
+    # Segment i goes from points[i] to points[i + 1]; cumulative[i] is the
+    # distance travelled when it starts.
+    self.segments = []
+    self.cumulative = []
+    total = 0
+    for start, end in zip(points, points[1:]):
+      length = math.hypot(end[0] - start[0], end[1] - start[1])
+      self.segments.append((start, end, length))
+      self.cumulative.append(total)
+      total += length
+    # Ends of the segments, for the binary search.
+    self.ends = self.cumulative[1:] + [total]
+    self.total_distance = total
+    self.total_time = total / max_velocity
+
+    if starting_velocity[0] == 0 and starting_velocity[1] == 0:
+      starting_velocity = (1, 0)
+    norm = math.sqrt(starting_velocity[0] ** 2 + starting_velocity[1] ** 2)
+    self.direction = (starting_velocity[0] / norm, starting_velocity[1] / norm)
+
+  def __repr__(self):
+    return 'ShipPath(%r, %r, %r, %r)' % (
+      self.start, self.direction, self.waypoints, self.max_velocity)
+
+  def Curve(self, progress):
+    """(x, y, dx, dy, segment) at a fraction of the total distance."""
+    distance = progress * self.total_distance
+    i = bisect.bisect_right(self.ends, distance)
+    if i == len(self.segments):
+      return self.waypoints[-1] + (0, 0, i)
+    start, end, length = self.segments[i]
+    small_progress = (distance - self.cumulative[i]) / length
+    return (
+      start[0] + (end[0] - start[0]) * small_progress,
+      start[1] + (end[1] - start[1]) * small_progress,
+      (end[0] - start[0]) / length,
+      (end[1] - start[1]) / length,
+      i)
+
+  def __call__(self, time):
+    total_distance, total_time = self.total_distance, self.total_time
+    if total_distance == 0:
+      return (self.start[0], self.start[1], 0, 0, None)
     if time < 0:
       distance = 0
       velocity = 0
@@ -68,22 +96,24 @@ def ShipPathFromWaypoints(starting_location, starting_velocity, waypoints, max_v
       distance = total_distance
       velocity = 0
     else:
-      velocity = max_velocity
+      velocity = self.max_velocity
       distance = time / total_time * total_distance
-    (locationX, locationY, directionX, directionY, index) = curve(distance / total_distance)
+    (locationX, locationY, directionX, directionY, index) = self.Curve(distance / total_distance)
     if time > total_time:
       return (locationX, locationY, None, None, index)
-    original_velocity_ratio = max(seconds_to_turn - time, 0) / seconds_to_turn
+    original_velocity_ratio = max(self.seconds_to_turn - time, 0) / self.seconds_to_turn
     if original_velocity_ratio > 0:
-      new_direction = numpy.array([directionX, directionY])
-      dot = new_direction.dot(original_direction)
+      ox, oy = self.direction
+      dot = directionX * ox + directionY * oy
       if dot < -0.9:
+        # Nearly reversing: turn the new direction back towards the old one.
         rad = math.acos(dot) * original_velocity_ratio
-        rotation_matrix = numpy.matrix([[math.cos(rad), -math.sin(rad)], [math.sin(rad), math.cos(rad)]])
-        new_direction = new_direction * rotation_matrix
+        cos, sin = math.cos(rad), math.sin(rad)
+        directionX, directionY = (directionX * cos + directionY * sin,
+                                  -directionX * sin + directionY * cos)
       else:
-        new_direction = original_direction * original_velocity_ratio + new_direction * (1 - original_velocity_ratio)
-      directionX, directionY = new_direction.item(0), new_direction.item(1)
+        directionX = ox * original_velocity_ratio + directionX * (1 - original_velocity_ratio)
+        directionY = oy * original_velocity_ratio + directionY * (1 - original_velocity_ratio)
     return (
       locationX,
       locationY,
@@ -91,13 +121,27 @@ def ShipPathFromWaypoints(starting_location, starting_velocity, waypoints, max_v
       directionY * velocity,
       index)
 
-  return control
 
+class Ship(entities.Entity):
+  # Game replaces this with a fresh store for each game.
+  store = entities.EntityStore()
+  x = entities.Column('x')
+  y = entities.Column('y')
+  prev_x = entities.Column('prev_x')
+  prev_y = entities.Column('prev_y')
+  dx = entities.Column('dx')
+  dy = entities.Column('dy')
+  health = entities.Column('health')
+  faction = entities.Column('faction')
+  size = entities.Column('size')
 
-class Ship(object):
   def __init__(self, x, y, size):
+    super(Ship, self).__init__()
     self.x = x
     self.y = y
+    # Position at the previous simulation step, for interpolated rendering.
+    self.prev_x = x
+    self.prev_y = y
     self.dx = 0
     self.dy = 0
     self.size = size
@@ -106,18 +150,24 @@ class Ship(object):
     self.faction = 1
     self.damage = 0
     self.AI = None
+    self.target_reevaluation = 0
+
+  def InterpolatedPosition(self, alpha):
+    return (self.prev_x + (self.x - self.prev_x) * alpha,
+            self.prev_y + (self.y - self.prev_y) * alpha)
 
 
 class SpriteShip(Ship):
   def __init__(self, x, y, size):
     super(SpriteShip, self).__init__(x, y, size)
     self.vbo = rendering.Quad(size, size)
-    self.texture = rendering.Texture(pygame.image.load('art/ships/birdie.png'))
+    self.texture = rendering.TEXTURES.Get('art/ships/birdie.png')
 
-  def Render(self):
+  def Render(self, alpha=1.0):
     glColor(1, 1, 1, 1)
+    x, y = self.InterpolatedPosition(alpha)
     glPushMatrix()
-    glTranslatef(self.x, self.y, 0)
+    glTranslatef(x, y, 0)
     with self.texture:
       self.vbo.Render()
     glPopMatrix()
@@ -128,26 +178,17 @@ class MeshShip(Ship):
     super(MeshShip, self).__init__(x, y, size)
     self.mesh = mesh
 
-  def Render(self):
+  def Render(self, alpha=1.0):
     d = math.hypot(self.dx, self.dy)
     if d:
       v = [self.dx / d, self.dy / d]
     else:
       v = [1, 0]
-    self.mesh.Render((self.x, self.y),
+    self.mesh.Render(self.InterpolatedPosition(alpha),
                      (self.size, self.size, self.size),
                      v)
 
 
-class Projectile(SpriteShip):
-  def __init__(self, x, y, size):
-    super(Projectile, self).__init__(x, y, size)
-    self.damage = 0.5
-    self.texture = rendering.Texture(pygame.image.load('art/ships/balls.png'))
-    self.max_velocity = 1.2
-    self.owner = None
-    self.lifetime = 0.5
-
 class JellyFish(MeshShip):
   id = 0
   def __init__(self, x, y, size):
@@ -0,0 +1,106 @@
+import math
+
+
+class SpatialHash(object):
+  """Uniform grid for finding the objects near a point.
+
+  Objects are inserted with a bounding circle and land in every cell the
+  circle's bounding box touches. Queries return candidates only, the caller
+  still has to do the exact distance check.
+  """
+
+  def __init__(self, cell_size):
+    self.cell_size = float(cell_size)
+    self.Clear()
+
+  def Clear(self):
+    self.cells = {}
+    self.count = 0
+    # Cell index bounds of everything ever inserted since the last Clear.
+    self.bounds = None
+
+  def Cell(self, x, y):
+    return (int(math.floor(x / self.cell_size)),
+            int(math.floor(y / self.cell_size)))
+
+  def CellRange(self, x, y, radius):
+    x0, y0 = self.Cell(x - radius, y - radius)
+    x1, y1 = self.Cell(x + radius, y + radius)
+    for i in xrange(x0, x1 + 1):
+      for j in xrange(y0, y1 + 1):
+        yield i, j
+
+  def Ring(self, i, j, r):
+    """Yields the cells exactly r cells away from cell (i, j)."""
+    if r == 0:
+      yield i, j
+      return
+    for k in xrange(i - r, i + r + 1):
+      yield k, j - r
+      yield k, j + r
+    for k in xrange(j - r + 1, j + r):
+      yield i - r, k
+      yield i + r, k
+
+  def Insert(self, obj, x, y, radius=0):
+    entry = (self.count, obj)
+    self.count += 1
+    for cell in self.CellRange(x, y, radius):
+      if cell in self.cells:
+        self.cells[cell].append(entry)
+      else:
+        self.cells[cell] = [entry]
+    x0, y0 = self.Cell(x - radius, y - radius)
+    x1, y1 = self.Cell(x + radius, y + radius)
+    if self.bounds is None:
+      self.bounds = [x0, y0, x1, y1]
+    else:
+      b = self.bounds
+      self.bounds = [min(b[0], x0), min(b[1], y0), max(b[2], x1), max(b[3], y1)]
+
+  def Remove(self, obj, x, y, radius=0):
+    """Removes an object. Takes the same position it was inserted with."""
+    for cell in self.CellRange(x, y, radius):
+      entries = self.cells.get(cell)
+      if entries:
+        entries[:] = [entry for entry in entries if entry[1] is not obj]
+        if not entries:
+          del self.cells[cell]
+
+  def Query(self, x, y, radius):
+    """Returns objects that may be within radius of (x, y).
+
+    The objects come in insertion order, so callers behave the same as when
+    looping over the original list.
+    """
+    found = {}
+    for cell in self.CellRange(x, y, radius):
+      for i, obj in self.cells.get(cell, ()):
+        found[i] = obj
+    return [found[i] for i in sorted(found)]
+
+  def Nearest(self, x, y):
+    """Returns (distance, obj) for the object closest to (x, y).
+
+    Objects need x and y attributes; their radius is ignored. Returns
+    (None, None) if there are no objects. Searches rings of cells outwards
+    and stops once no further ring can hold anything closer.
+    """
+    best = None, None
+    if not self.cells:
+      return best
+    i, j = self.Cell(x, y)
+    b = self.bounds
+    last_ring = max(i - b[0], j - b[1], b[2] - i, b[3] - j)
+    r = 0
+    while r <= last_ring:
+      for cell in self.Ring(i, j, r):
+        for _, obj in self.cells.get(cell, ()):
+          distance = math.hypot(obj.x - x, obj.y - y)
+          if best[0] is None or distance < best[0]:
+            best = distance, obj
+      # Anything in ring r + 1 is at least r cells away.
+      if best[0] is not None and best[0] <= r * self.cell_size:
+        break
+      r += 1
+    return best
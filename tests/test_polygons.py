@@ -0,0 +1,74 @@
+import random
+import unittest
+
+import rendering
+rendering.HEADLESS = True
+import crystals
+
+
+def Fill(n, seed=3):
+  """Makes n available crystals spread over the field.
+
+  Returns the Crystals, how many traces and how many looked-at crystals the
+  second half of the additions cost.
+  """
+  rng = random.Random(seed)
+  field = crystals.Crystals(n, rng=rng)
+  index = field.polygons
+  counts = {'traces': 0, 'examined': 0}
+  trace, query = index.Trace, field.Query
+  def CountingTrace(*args):
+    counts['traces'] += 1
+    return trace(*args)
+  def CountingQuery(*args):
+    found = query(*args)
+    counts['examined'] += len(found)
+    return found
+  index.Trace, field.Query = CountingTrace, CountingQuery
+  for i in range(n):
+    if i == n // 2:
+      counts = {'traces': 0, 'examined': 0}
+    crystal = crystals.Crystal((rng.uniform(field.min_x, field.max_x), rng.uniform(field.min_y, field.max_y)))
+    field.Add(crystal)
+    crystal.visible = True
+    index.Sync(crystal)
+  added = n - n // 2
+  return field, counts['traces'] / float(added), counts['examined'] / float(added)
+
+
+class PolygonIndexTest(unittest.TestCase):
+
+  def testSizeAndCostStayFlat(self):
+    small, small_traces, small_examined = Fill(250)
+    large, large_traces, large_examined = Fill(1000)
+    index = large.polygons
+    bound = len(index.kinds) * index.per_crystal
+    self.assertLessEqual(len(small.polygons), bound * 250)
+    self.assertLessEqual(len(index), bound * 1000)
+    # Polygons per crystal barely change with four times the crystals.
+    self.assertLess(len(index) / 1000., 1.5 * len(small.polygons) / 250.)
+    # So do the traces per added crystal, and the crystals looked at grow
+    # much slower than the crystal count.
+    self.assertLessEqual(large_traces, index.neighbours * len(index.kinds) * 2)
+    self.assertLess(large_traces, 1.5 * small_traces)
+    self.assertLess(large_examined, 3 * small_examined)
+
+  def testBestIsAvailable(self):
+    field, traces, examined = Fill(300)
+    score, path = field.polygons.Best()
+    path[0].in_shape = True
+    best = field.polygons.Best()
+    self.assertTrue(best is None or path[0] not in best[1])
+
+  def testRemoveDropsPolygons(self):
+    field, traces, examined = Fill(300)
+    index = field.polygons
+    for crystal in list(field):
+      crystal.visible = False
+      index.Sync(crystal)
+    self.assertEqual(len(index), 0)
+    self.assertEqual(index.Best(), None)
+
+
+if __name__ == '__main__':
+  unittest.main()